@@ -1,33 +1,1660 @@
-from flask import Flask, render_template, request, send_from_directory, jsonify, url_for
+from flask import Flask, render_template, request, send_file, jsonify, url_for, Response
 import os
 import pandas as pd
 import re
 from openpyxl import load_workbook
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill, Protection
-from openpyxl.utils import get_column_letter
-from datetime import datetime
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.cell.cell import Cell
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE, BUILTIN_FORMATS_MAX_SIZE
+from datetime import datetime, date
+import io
 import json
+import csv
+import mimetypes
 from pathlib import Path
 import subprocess
 import platform
 from weasyprint import HTML
 from jinja2 import Template
+from werkzeug.security import safe_join
 import shutil
 import threading
-from queue import Queue
+import heapq
 import time
-import copy
+import hashlib
+import pickle
+import uuid
+import zipfile
+import sqlite3
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+from pypdf import PdfReader, PdfWriter
+from collections import OrderedDict, deque
+from itertools import islice
+import math
+import ctypes
+import ctypes.util
+import select
+import struct
+from queue import Queue, Empty
+import urllib.parse
+import http.client
+import ssl
+import socket
+import ipaddress
+
+try:
+    # O módulo uno só está disponível no Python que acompanha o LibreOffice
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+try:
+    import fcntl
+except ImportError:
+    # Indisponível no Windows, onde a conversão também não é suportada
+    fcntl = None
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DOWNLOAD_FOLDER'] = 'downloads'  # Pasta para PDFs gerados
 app.config['TEMP_FOLDER'] = 'temp'  # Pasta para arquivos XLSX processados
+app.config['SPOOL_FOLDER'] = os.environ.get('SPOOL_FOLDER', '/dev/shm/apipdf' if os.path.isdir('/dev/shm') else 'temp')  # XLSX usados só na conversão, de preferência em tmpfs
+app.config['KEEP_EXCEL'] = os.environ.get('KEEP_EXCEL', '1').lower() not in ('0', 'false')  # Padrão de ?excel=: manter o XLSX e devolver o excel_url
 app.config['MODEL_INFO'] = {}  # Armazena informações dos modelos
-app.config['CONVERSION_QUEUE'] = Queue()  # Fila para conversão de PDFs
-app.config['CONVERSION_STATUS'] = {}  # Status das conversões
+app.config['RENDER_PLANS'] = {}  # Planos de renderização compilados de cada modelo
+app.config['PENDING_MODELS'] = set()  # Modelos ainda não analisados (carregados sob demanda)
+app.config['TEMPLATE_VERSION_GRACE'] = int(os.environ.get('TEMPLATE_VERSION_GRACE', 3600))  # Tempo que uma versão substituída continua disponível
+app.config['TEMPLATE_WATCH'] = os.environ.get('TEMPLATE_WATCH', '1').lower() not in ('0', 'false')  # Recarrega os modelos alterados em UPLOAD_FOLDER
+app.config['TEMPLATE_WATCH_INTERVAL'] = 2  # Intervalo da verificação quando o inotify não está disponível
+app.config['TEMPLATE_WATCH_DEBOUNCE'] = 0.5  # Espera sem novos eventos antes de analisar um arquivo alterado
+app.config['MODEL_LOCK'] = threading.Lock()  # Serializa a troca das versões publicadas dos modelos
+app.config['MODEL_STORE_FOLDER'] = 'model_store'  # Dados internos dos modelos, fora das pastas servidas em /download
+app.config['MODEL_INDEX_PATH'] = os.path.join(app.config['MODEL_STORE_FOLDER'], 'model_index.sqlite')  # Índice persistido dos modelos
+app.config['TEMPLATE_VERSIONS_FOLDER'] = os.path.join(app.config['MODEL_STORE_FOLDER'], 'versions')  # Versões imutáveis dos modelos, nomeadas pelo hash
+
+# Versão do formato do plano gravado no índice; ao mudar o plano, incremente para reanalisar os modelos
+MODEL_INDEX_FORMAT = 8
+app.config['CONVERSION_QUEUE_MAX_DEPTH'] = int(os.environ.get('CONVERSION_QUEUE_MAX_DEPTH', 1000))  # Jobs aguardando conversão
+app.config['STATUS_STORE'] = os.environ.get('STATUS_STORE', 'sqlite')  # 'sqlite' (compartilhado entre processos) ou 'memory'
+app.config['STATUS_DB_PATH'] = os.environ.get('STATUS_DB_PATH', 'conversion_status.sqlite')  # Banco dos status no modo sqlite
+app.config['STATUS_TTL'] = int(os.environ.get('STATUS_TTL', 24 * 3600))  # Tempo de vida de cada status
+app.config['STATUS_MAX_ENTRIES'] = int(os.environ.get('STATUS_MAX_ENTRIES', 100000))  # Limite de status guardados
+app.config['SSE_HEARTBEAT'] = 15  # Intervalo das mensagens de manutenção dos fluxos de eventos
+app.config['SSE_MAX_IDS'] = 100  # Conversões acompanhadas por um único fluxo de eventos
+app.config['CALLBACK_ALLOWED_HOSTS'] = [host for host in os.environ.get('CALLBACK_ALLOWED_HOSTS', '').split(',') if host]  # Vazio: qualquer host com endereço público
+app.config['CALLBACK_MAX_ATTEMPTS'] = 5  # Tentativas de entrega de cada callback
+app.config['CALLBACK_TIMEOUT'] = 10  # Tempo limite de cada POST de callback
+app.config['CONVERTER_POOL_SIZE'] = int(os.environ.get('CONVERTER_POOL_SIZE', 2))  # Instâncias do LibreOffice
+app.config['CONVERTER_BASE_PORT'] = int(os.environ.get('CONVERTER_BASE_PORT', 2002))  # Porta UNO da primeira instância
+app.config['CONVERTER_PROFILE_FOLDER'] = 'office_profiles'  # Perfis de usuário de cada instância
+app.config['CONVERTER_MAX_SLOTS'] = 64  # Processos da aplicação com pool próprio no mesmo host
+app.config['CONVERTER_REQUIRE_UNO'] = os.environ.get('CONVERTER_REQUIRE_UNO', '0').lower() in ('1', 'true')  # Falha ao iniciar sem o módulo uno
+app.config['CONVERTER_START_TIMEOUT'] = 30  # Segundos para o LibreOffice aceitar conexões
+app.config['CONVERTER_HEALTH_INTERVAL'] = 10  # Intervalo da verificação de saúde das instâncias
+app.config['CONVERSION_TIMEOUT'] = 60  # Tempo limite de cada conversão
+app.config['CHUNK_ROWS'] = int(os.environ.get('CHUNK_ROWS', 20000))  # Linhas por parte no modo ?chunked=1
+app.config['MAX_WAIT_SECONDS'] = 120  # Limite do parâmetro ?wait= na geração
+app.config['MAX_BATCH_ITEMS'] = 5000  # Documentos por requisição de lote
+app.config['MODELS_PER_PAGE'] = 50  # Modelos por página em /api/models
+app.config['MODELS_MAX_PER_PAGE'] = 500  # Limite do parâmetro ?per_page=
+app.config['INDEX_PAGE_SIZE'] = 20  # Modelos por página na interface
+app.config['PAYLOAD_MAX_ERRORS'] = 100  # Erros listados na resposta de um payload inválido
+app.config['STREAM_CHUNK_ROWS'] = 10000  # Linhas lidas por vez das tabelas enviadas em NDJSON/CSV
+app.config['MODEL_SETTINGS'] = {}  # Configurações por modelo, persistidas em uploads/model_settings.json
+
+# Motores de renderização disponíveis: LibreOffice (fidelidade) ou WeasyPrint (direto, sem processo externo)
+RENDER_ENGINES = ('libreoffice', 'weasyprint')
+
+# Prioridades da fila de conversão, da mais urgente para a menos urgente
+PRIORITIES = ('high', 'normal', 'low')
+app.config['TEMPLATE_CACHE_MAX_BYTES'] = int(os.environ.get('TEMPLATE_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # Limite do cache de modelos
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # Limite dos PDFs em cache
+app.config['RESULT_CACHE_TTL'] = int(os.environ.get('RESULT_CACHE_TTL', 24 * 3600))  # Tempo de vida dos PDFs em cache
+app.config['RESULT_CACHE_LOCK_FOLDER'] = 'cache_locks'  # Bloqueios do cache de resultados compartilhados entre os processos
+app.config['CLEANUP_DELAY'] = int(os.environ.get('CLEANUP_DELAY', 3600))  # Tempo até remover os arquivos temporários de um job
+app.config['DISK_QUOTA_BYTES'] = int(os.environ.get('DISK_QUOTA_BYTES', 5 * 1024 * 1024 * 1024))  # Limite de disco de temp/ e downloads/
+app.config['JANITOR_INTERVAL'] = 60  # Intervalo máximo entre as verificações da limpeza
+app.config['ARTIFACT_INDEX_MAX_ENTRIES'] = 100000  # Arquivos lembrados pelo índice de downloads
+app.config['DOWNLOAD_ACCEL'] = os.environ.get('DOWNLOAD_ACCEL', '')  # '', 'x-accel-redirect' (nginx) ou 'x-sendfile' (Apache, lighttpd)
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected')  # Location interna do nginx que aponta para a pasta da aplicação
+
+def file_version(filepath):
+    """Retorna o hash do conteúdo do arquivo, usado como versão do modelo"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class TemplateCache:
+    """Cache LRU dos modelos já interpretados, limitado pelo tamanho estimado em memória.
+
+    Cada entrada guarda o workbook serializado com pickle; cada requisição recebe uma
+    cópia isolada desserializando os bytes, o que é bem mais barato que reler o XLSX.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (modelo, versão) -> workbook serializado
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get_workbook(self, filename, version, filepath):
+        """Retorna uma cópia do workbook do modelo, carregando do disco se necessário"""
+        key = (filename, version)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+        
+        if data is None:
+            wb = load_workbook(filepath)
+            data = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+            wb.close()
+            self._store(key, data)
+        
+        return pickle.loads(data)
+
+    def _store(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            # Remove os modelos usados há mais tempo até caber no limite
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, filename):
+        """Remove todas as versões em cache de um modelo"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == filename]:
+                self.size -= len(self.entries.pop(key))
+
+app.config['TEMPLATE_CACHE'] = TemplateCache(app.config['TEMPLATE_CACHE_MAX_BYTES'])
+
+class ResultCache:
+    """Cache dos PDFs gerados, endereçado pelo hash da versão do modelo e do payload.
+
+    Requisições idênticas simultâneas são unidas em um único job em andamento, e os
+    PDFs da pasta de downloads são removidos por tempo de vida e por tamanho total.
+    O XLSX mantido para o excel_url acompanha a entrada do PDF e sai junto com ele.
+
+    Entre os processos da aplicação, cada resultado tem um arquivo de bloqueio em
+    lock_folder: o processo que gera o PDF o mantém exclusivo até indexá-lo, e só quem
+    obtém o bloqueio exclusivo remove os arquivos. O último uso é compartilhado pela data
+    de acesso do PDF, renovada a cada acerto.
+    """
+
+    CACHED_NAME = re.compile(r'generated_.+_[0-9a-f]{32}\.pdf')  # Nome dado aos PDFs em cache (base_name da geração)
+
+    def __init__(self, folder, excel_folder, lock_folder, max_bytes, ttl):
+        self.folder = folder
+        self.excel_folder = excel_folder
+        self.lock_folder = lock_folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # caminho do PDF -> (tamanho, criado em, XLSX ou None, usado em); ordem de uso
+        self.excel_paths = set()  # XLSX que pertencem a uma entrada
+        self.size = 0
+        self.inflight = {}  # chave -> job em andamento
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Reconstrói o índice a partir dos PDFs já existentes na pasta"""
+        if not os.path.exists(self.folder):
+            return
+        files = []
+        for filename in os.listdir(self.folder):
+            # Só os PDFs endereçados pela chave; os demais seguem a limpeza dos jobs
+            if self.CACHED_NAME.fullmatch(filename):
+                path = os.path.join(self.folder, filename)
+                stat = os.stat(path)
+                files.append((stat.st_atime, path, stat.st_size, stat.st_mtime))
+        for used, path, size, created in sorted(files):
+            excel_path = os.path.join(self.excel_folder, os.path.basename(path)[:-4] + '.xlsx')
+            self._add(path, size, created, excel_path if os.path.exists(excel_path) else None, used)
+
+    @staticmethod
+    def key_for(version, engine, data, keep_excel=False):
+        """Chave do resultado: versão do modelo, motor de renderização e payload canônico.
+
+        Tabelas recebidas em NDJSON/CSV entram na chave pelo hash do arquivo. Pedidos com
+        e sem o XLSX (?excel) são entradas distintas, para que um não sirva o outro.
+        """
+        canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                               default=lambda value: value.digest if isinstance(value, TableStream) else str(value))
+        variant = '|xlsx' if keep_excel else ''
+        return hashlib.sha256(f'{version}|{engine}{variant}|{canonical}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, pdf_path, excel_path=None):
+        """Retorna a entrada (tamanho, criado em, XLSX ou None, usado em) se o PDF existe e não expirou.
+
+        Um PDF gravado por outro processo é adotado, desde que o XLSX esperado
+        (excel_path) também exista. Uma entrada cujo PDF ou XLSX foi removido por fora
+        conta como ausente, assim como um PDF que outro processo está gravando.
+        """
+        with self.lock:
+            entry = self.entries.get(pdf_path)
+            if not os.path.exists(pdf_path):
+                if entry:
+                    self._remove(pdf_path)
+                return None
+            lock_file = self._lock(pdf_path, shared=True)
+            if lock_file is None:
+                return None
+            with lock_file:
+                if entry is None:
+                    entry = self._adopt(pdf_path, excel_path)
+                    if entry is None:
+                        return None
+                expired = time.time() - entry[1] > self.ttl or (entry[2] and not os.path.exists(entry[2]))
+                if not expired:
+                    # Renova o último uso para as remoções dos outros processos
+                    now = time.time()
+                    try:
+                        os.utime(pdf_path, (now, entry[1]))
+                    except OSError:
+                        pass
+                    entry = self.entries[pdf_path] = entry[:3] + (now,)
+                    self.entries.move_to_end(pdf_path)
+                    return entry
+            self._remove(pdf_path)
+            return None
+
+    def _adopt(self, pdf_path, excel_path):
+        """Indexa um PDF gerado por outro processo; None se ele expirou ou falta o XLSX"""
+        try:
+            stat = os.stat(pdf_path)
+            size = stat.st_size + (os.path.getsize(excel_path) if excel_path else 0)
+        except OSError:
+            return None
+        if time.time() - stat.st_mtime > self.ttl:
+            return None
+        self._add(pdf_path, size, stat.st_mtime, excel_path, stat.st_atime)
+        return self.entries[pdf_path]
+
+    def claim(self, key, job):
+        """Registra o job como o responsável pela chave ou retorna o job idêntico em andamento.
+
+        Se outro processo está gerando o mesmo resultado, retorna um job que acompanha a
+        conclusão dele.
+        """
+        with self.lock:
+            running = self.inflight.get(key)
+            if running:
+                return running
+            lock_file = self._lock(job['pdf_path'])
+            if lock_file is not None:
+                job['cache_lock'] = lock_file
+                self.inflight[key] = job
+                return job
+            follower = dict(job, callbacks=[], done=threading.Event())
+            self.inflight[key] = follower
+        threading.Thread(target=self._follow, args=(follower,), daemon=True).start()
+        return follower
+
+    def _follow(self, job):
+        """Aguarda o processo que detém o resultado liberar o bloqueio e conclui o job"""
+        lock_file = self._lock(job['pdf_path'], shared=True, blocking=True)
+        if lock_file:
+            lock_file.close()
+        
+        conversion_id = job['conversion_id']
+        entry = self.lookup(job['pdf_path'], job['excel_paths'][0] if job['keep_excel'] else None)
+        if entry:
+            job['keep_excel'] = entry[2] is not None
+            app.config['CONVERSION_STATUS'][conversion_id] = {
+                'status': 'completed',
+                'message': 'Conversão concluída com sucesso',
+                'pdf_url': f'/download/{conversion_id}'
+            }
+        elif app.config['CONVERSION_STATUS'].get(conversion_id, {}).get('status') not in FINAL_STATUSES:
+            app.config['CONVERSION_STATUS'][conversion_id] = {
+                'status': 'error',
+                'message': 'A conversão foi interrompida em outro processo'
+            }
+        
+        with self.lock:
+            if self.inflight.get(job['cache_key']) is job:
+                del self.inflight[job['cache_key']]
+        job['done'].set()
+        flush_callbacks(job)
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries or path in self.excel_paths
+
+    def finish(self, job):
+        """Libera a chave do job e indexa o PDF gerado, com o XLSX mantido para o excel_url"""
+        with self.lock:
+            if self.inflight.get(job['cache_key']) is job:
+                del self.inflight[job['cache_key']]
+            lock_file = job.pop('cache_lock', None)
+            try:
+                pdf_path = job['pdf_path']
+                if not os.path.exists(pdf_path):
+                    # Falha na geração: o bloqueio não acompanha nenhum resultado
+                    if lock_file:
+                        os.remove(self._lock_path(pdf_path))
+                    return
+                if pdf_path in self.entries:
+                    return
+                excel_path = job['excel_paths'][0] if job['keep_excel'] else None
+                if excel_path and not os.path.exists(excel_path):
+                    excel_path = None
+                size = os.path.getsize(pdf_path) + (os.path.getsize(excel_path) if excel_path else 0)
+                now = time.time()
+                self._add(pdf_path, size, now, excel_path, now)
+            finally:
+                if lock_file:
+                    lock_file.close()
+            self._evict()
+
+    def _add(self, pdf_path, size, created, excel_path, used):
+        self.entries[pdf_path] = (size, created, excel_path, used)
+        if excel_path:
+            self.excel_paths.add(excel_path)
+        self.size += size
+
+    def reclaim(self, bytes_needed=0):
+        """Remove os PDFs expirados e, se preciso, os usados há mais tempo até liberar bytes_needed"""
+        with self.lock:
+            freed = 0
+            now = time.time()
+            for path, entry in list(self.entries.items()):
+                if now - entry[1] > self.ttl:
+                    freed += self._remove(path)
+            while freed < bytes_needed and self.entries:
+                freed += self._remove(self._least_recent())
+            return freed
+
+    def _evict(self):
+        now = time.time()
+        for path, entry in list(self.entries.items()):
+            if now - entry[1] > self.ttl:
+                self._remove(path)
+        # Remove os PDFs usados há mais tempo até caber no limite
+        while self.size > self.max_bytes and self.entries:
+            self._remove(self._least_recent())
+
+    def _least_recent(self):
+        """PDF usado há mais tempo, considerando os acertos registrados por outros processos"""
+        for _ in range(len(self.entries)):
+            path, entry = next(iter(self.entries.items()))
+            try:
+                used = os.stat(path).st_atime
+            except OSError:
+                return path
+            if used <= entry[3] + 1:
+                return path
+            self.entries[path] = entry[:3] + (used,)
+            self.entries.move_to_end(path)
+        return next(iter(self.entries))
+
+    def _remove(self, path):
+        size, _, excel_path, _ = self.entries.pop(path)
+        self.size -= size
+        self.excel_paths.discard(excel_path)
+        lock_file = self._lock(path)
+        if lock_file is None:
+            # Outro processo está usando ou gravando o resultado: só sai do índice local
+            return size
+        with lock_file:
+            for removed in (path, excel_path):
+                try:
+                    if removed and os.path.exists(removed):
+                        os.remove(removed)
+                except Exception as e:
+                    print(f"Erro ao remover arquivo do cache: {str(e)}")
+            os.remove(self._lock_path(path))
+        return size
+
+    def _lock_path(self, pdf_path):
+        return os.path.join(self.lock_folder, os.path.basename(pdf_path)[:-4] + '.lock')
+
+    def _lock(self, pdf_path, shared=False, blocking=False):
+        """Abre e bloqueia o arquivo de bloqueio do resultado; None se outro processo o detém"""
+        path = self._lock_path(pdf_path)
+        os.makedirs(self.lock_folder, exist_ok=True)
+        while True:
+            lock_file = open(path, 'a')
+            if fcntl is None:
+                return lock_file
+            try:
+                fcntl.flock(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except OSError:
+                lock_file.close()
+                return None
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    return lock_file
+            except OSError:
+                pass
+            # O arquivo foi removido por quem detinha o bloqueio: bloqueia o novo
+            lock_file.close()
+
+app.config['RESULT_CACHE'] = ResultCache(app.config['DOWNLOAD_FOLDER'], app.config['TEMP_FOLDER'],
+                                         app.config['RESULT_CACHE_LOCK_FOLDER'],
+                                         app.config['RESULT_CACHE_MAX_BYTES'], app.config['RESULT_CACHE_TTL'])
+
+class ArtifactIndex:
+    """Índice dos arquivos servidos em /download: caminho, tamanho e hash do conteúdo.
+
+    Os arquivos gerados são registrados ao serem gravados; os demais (modelos enviados
+    ou arquivos de antes de reiniciar) são procurados nas pastas na primeira requisição.
+    Cada consulta confere a entrada com um único stat, descartando arquivos removidos
+    ou alterados.
+    """
+
+    def __init__(self, folders, max_entries, template_folder=None):
+        self.folders = folders
+        self.template_folder = template_folder  # Só os modelos publicados são servidos desta pasta
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # nome -> {'path', 'size', 'mtime_ns', 'hash'}; ordem de uso
+        self.lock = threading.Lock()
+
+    def add(self, path, name=None):
+        """Registra o arquivo, calculando o hash do conteúdo, e retorna a entrada"""
+        stat = os.stat(path)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        entry = {
+            'path': path,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': digest.hexdigest()
+        }
+        with self.lock:
+            self.entries[name or os.path.basename(path)] = entry
+            self.entries.move_to_end(name or os.path.basename(path))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def lookup(self, name):
+        """Retorna a entrada do arquivo ou None se ele não existe em nenhuma das pastas"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry:
+                self.entries.move_to_end(name)
+        if entry:
+            try:
+                stat = os.stat(entry['path'])
+                if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+                    return entry
+            except OSError:
+                pass
+            with self.lock:
+                self.entries.pop(name, None)
+        
+        folders = list(self.folders)
+        if self.template_folder and (name in app.config['RENDER_PLANS'] or name in app.config['PENDING_MODELS']):
+            folders.append(self.template_folder)
+        for folder in folders:
+            path = safe_join(folder, name)
+            if path and os.path.isfile(path):
+                try:
+                    return self.add(path, name)
+                except OSError:
+                    return None
+        return None
+
+app.config['ARTIFACTS'] = ArtifactIndex([app.config['DOWNLOAD_FOLDER'], app.config['TEMP_FOLDER']],
+                                        app.config['ARTIFACT_INDEX_MAX_ENTRIES'], app.config['UPLOAD_FOLDER'])
+
+def path_size(path):
+    """Tamanho em bytes de um arquivo ou de todo o conteúdo de uma pasta"""
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    except OSError:
+        return 0
+
+class Janitor:
+    """Remove os arquivos temporários dos jobs em uma única thread.
+
+    Os prazos de remoção ficam em um heap. Ao iniciar, o estado é reconstruído a partir
+    das pastas, e quando o uso de disco passa da cota os arquivos mais antigos são
+    removidos primeiro; os PDFs do cache de resultados seguem a política do próprio cache.
+    """
+
+    def __init__(self, folders, delay, quota, result_cache):
+        self.folders = folders
+        self.delay = delay
+        self.quota = quota
+        self.result_cache = result_cache
+        self.heap = []  # (expira em, caminho)
+        self.scheduled = {}  # caminho -> (expira em, tamanho)
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def start(self):
+        """Agenda os arquivos deixados pela execução anterior e inicia a thread de limpeza"""
+        count = 0
+        with self.condition:
+            for folder in self.folders:
+                if not os.path.exists(folder):
+                    continue
+                for name in os.listdir(folder):
+                    path = os.path.join(folder, name)
+                    if path in self.result_cache:
+                        continue
+                    try:
+                        expires = os.path.getmtime(path) + self.delay
+                    except OSError:
+                        continue
+                    self._push(path, expires)
+                    count += 1
+        print(f"Limpeza: {count} arquivos existentes agendados ({self.size} bytes)")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, *paths):
+        """Agenda a remoção dos arquivos após o prazo configurado"""
+        expires = time.time() + self.delay
+        with self.condition:
+            for path in paths:
+                self._push(path, expires)
+            self.condition.notify()
+
+    def _push(self, path, expires):
+        previous = self.scheduled.pop(path, None)
+        if previous:
+            self.size -= previous[1]
+        size = path_size(path)
+        self.scheduled[path] = (expires, size)
+        self.size += size
+        heapq.heappush(self.heap, (expires, path))
+
+    def _collect(self):
+        """Retira do heap os arquivos vencidos e, acima da cota, os mais antigos"""
+        now = time.time()
+        due = []
+        while self.heap:
+            expires, path = self.heap[0]
+            entry = self.scheduled.get(path)
+            if entry is None or entry[0] != expires:
+                # Entrada substituída por um novo agendamento do mesmo caminho
+                heapq.heappop(self.heap)
+                continue
+            if expires > now and self.size + self.result_cache.size <= self.quota:
+                break
+            heapq.heappop(self.heap)
+            del self.scheduled[path]
+            self.size -= entry[1]
+            due.append((path, entry[1]))
+        return due
+
+    def _run(self):
+        while True:
+            with self.condition:
+                due = self._collect()
+                if not due:
+                    timeout = app.config['JANITOR_INTERVAL']
+                    if self.heap:
+                        timeout = min(timeout, max(self.heap[0][0] - time.time(), 0))
+                    self.condition.wait(timeout)
+                    due = self._collect()
+                excess = self.size + self.result_cache.size - self.quota
+            
+            reclaimed = 0
+            for path, size in due:
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                    else:
+                        continue
+                    reclaimed += size
+                except Exception as e:
+                    print(f"Erro ao limpar arquivos temporários: {str(e)}")
+            
+            # Sem arquivos temporários a remover, a cota é respeitada removendo PDFs do cache
+            reclaimed += self.result_cache.reclaim(max(excess, 0))
+            if reclaimed:
+                print(f"Limpeza: {len(due)} arquivos temporários removidos, {reclaimed} bytes liberados")
+
+app.config['JANITOR'] = Janitor(sorted({app.config['TEMP_FOLDER'], app.config['SPOOL_FOLDER'], app.config['DOWNLOAD_FOLDER']}),
+                                 app.config['CLEANUP_DELAY'], app.config['DISK_QUOTA_BYTES'],
+                                 app.config['RESULT_CACHE'])
+
+class MemoryStatusStore:
+    """Status das conversões em memória, visível apenas no próprio processo"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # id -> (atualizado em, status)
+        self.lock = threading.Lock()
+
+    def __setitem__(self, conversion_id, status):
+        with self.lock:
+            self.entries.pop(conversion_id, None)
+            self.entries[conversion_id] = (time.time(), status)
+            # Remove os status expirados e os mais antigos acima do limite
+            expires = time.time() - self.ttl
+            while self.entries:
+                oldest_id, (updated, _) = next(iter(self.entries.items()))
+                if updated >= expires and len(self.entries) <= self.max_entries:
+                    break
+                del self.entries[oldest_id]
+
+    def get(self, conversion_id, default=None):
+        with self.lock:
+            entry = self.entries.get(conversion_id)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return default
+        return entry[1]
+
+    def __delitem__(self, conversion_id):
+        with self.lock:
+            self.entries.pop(conversion_id, None)
+
+class SQLiteStatusStore:
+    """Status das conversões em SQLite (modo WAL), compartilhado por todos os processos do host"""
+
+    # A cada quantas gravações o processo remove os status expirados ou excedentes
+    PRUNE_INTERVAL = 200
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+        with self._connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS conversion_status (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            connection.execute('CREATE INDEX IF NOT EXISTS conversion_status_updated ON conversion_status (updated)')
+
+    def _connection(self):
+        """Uma conexão por thread"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def __setitem__(self, conversion_id, status):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO conversion_status VALUES (?, ?, ?)',
+                               (conversion_id, json.dumps(status), time.time()))
+        self.writes += 1
+        if self.writes % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def get(self, conversion_id, default=None):
+        row = self._connection().execute(
+            'SELECT status FROM conversion_status WHERE id = ? AND updated >= ?',
+            (conversion_id, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __delitem__(self, conversion_id):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM conversion_status WHERE id = ?', (conversion_id,))
+
+    def prune(self):
+        """Remove os status expirados e os mais antigos acima do limite"""
+        try:
+            with self._connection() as connection:
+                connection.execute('DELETE FROM conversion_status WHERE updated < ?', (time.time() - self.ttl,))
+                connection.execute("""
+                    DELETE FROM conversion_status WHERE id IN (
+                        SELECT id FROM conversion_status ORDER BY updated DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_entries,))
+        except Exception as e:
+            print(f"Erro ao limpar status das conversões: {str(e)}")
+
+class StatusNotifier:
+    """Envolve o armazenamento de status e repassa cada mudança aos assinantes do processo"""
+
+    def __init__(self, store):
+        self.store = store
+        self.subscribers = {}  # conversion_id -> filas dos fluxos de eventos
+        self.lock = threading.Lock()
+
+    def __setitem__(self, conversion_id, status):
+        self.store[conversion_id] = status
+        with self.lock:
+            queues = list(self.subscribers.get(conversion_id, ()))
+        for events in queues:
+            events.put((conversion_id, status))
+
+    def get(self, conversion_id, default=None):
+        return self.store.get(conversion_id, default)
+
+    def __delitem__(self, conversion_id):
+        del self.store[conversion_id]
+
+    def subscribe(self, conversion_ids):
+        """Retorna uma fila que recebe (conversion_id, status) a cada mudança"""
+        events = Queue()
+        with self.lock:
+            for conversion_id in conversion_ids:
+                self.subscribers.setdefault(conversion_id, set()).add(events)
+        return events
+
+    def unsubscribe(self, conversion_ids, events):
+        with self.lock:
+            for conversion_id in conversion_ids:
+                queues = self.subscribers.get(conversion_id)
+                if queues is not None:
+                    queues.discard(events)
+                    if not queues:
+                        del self.subscribers[conversion_id]
+
+def create_status_store():
+    """Cria o armazenamento de status configurado em STATUS_STORE"""
+    if app.config['STATUS_STORE'] == 'memory':
+        store = MemoryStatusStore(app.config['STATUS_TTL'], app.config['STATUS_MAX_ENTRIES'])
+    else:
+        store = SQLiteStatusStore(app.config['STATUS_DB_PATH'], app.config['STATUS_TTL'], app.config['STATUS_MAX_ENTRIES'])
+    return StatusNotifier(store)
+
+app.config['CONVERSION_STATUS'] = create_status_store()  # Status das conversões
+
+def find_calculation(text):
+    """Retorna o conteúdo do primeiro %[...] do texto, até o colchete que o fecha, ou None"""
+    start = text.find('%[')
+    if start < 0:
+        return None
+    
+    # Conta a profundidade como split_arguments, para suportar operações compostas
+    depth = 0
+    for index in range(start + 1, len(text)):
+        char = text[index]
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+            if depth == 0:
+                return text[start + 2:index] if char == ']' else None
+    return None
+
+def parse_calculation(cell):
+    """Interpreta uma célula de cálculo no formato %[...].
+
+    Texto entre %[ e ] que não é uma expressão, como %[a] ou %[a.b], fica no documento
+    como texto. Operações, como somar(...), sempre são interpretadas, e os erros nelas
+    (operação desconhecida, argumento inválido) invalidam o modelo.
+    """
+    expression_text = find_calculation(str(cell.value))
+    if expression_text is None:
+        return None
+    
+    try:
+        expression = parse_expression(expression_text)
+    except ValueError as e:
+        if not re.match(r'\s*\[?\s*\w+\s*\(', expression_text):
+            return None
+        raise TemplateError(f'Cálculo inválido em {cell.coordinate}: {str(e)}')
+    
+    calc_info = {
+        'type': 'compound',
+        'expression': expression,
+        'column': cell.column,
+        'row': cell.row,
+        'original_text': cell.value
+    }
+    # Agregados simples, como %[produtos.valor.somar], são formatados pelo tipo do campo
+    if expression['kind'] == 'aggregate':
+        calc_info.update(type='simple', operation=expression['operation'], table_name=expression['table_name'],
+                         field_name=expression['field_name'])
+    return calc_info
+
+class TemplateError(Exception):
+    """Erro no modelo enviado, como um cálculo inválido ou com referência circular"""
+
+# Operações das expressões compostas; todas aceitam dois ou mais argumentos
+EXPRESSION_OPERATIONS = ('somar', 'subtrair', 'multiplicar', 'dividir')
+
+def split_arguments(text):
+    """Separa os argumentos de uma operação pelas vírgulas fora de parênteses e colchetes"""
+    arguments = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(text):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+            if depth < 0:
+                raise ValueError('parênteses ou colchetes desbalanceados')
+        elif char == ',' and depth == 0:
+            arguments.append(text[start:index])
+            start = index + 1
+    if depth != 0:
+        raise ValueError('parênteses ou colchetes desbalanceados')
+    arguments.append(text[start:])
+    return arguments
+
+def parse_expression(text):
+    """Interpreta o conteúdo de %[...] como uma árvore de expressão.
+
+    Cada argumento, entre colchetes ou não, pode ser um agregado (tabela.campo.operação),
+    um número, uma variável ($nome), outra célula de cálculo (@C7) ou uma operação
+    aninhada, como somar([produtos.valor.somar], multiplicar([$frete], [1,1])). Cada nó
+    recebe uma chave canônica usada na memoização da avaliação.
+    """
+    text = text.strip()
+    if text.startswith('[') and text.endswith(']') and len(split_arguments(text)) == 1:
+        return parse_expression(text[1:-1])
+    
+    call = re.fullmatch(r'(\w+)\s*\((.*)\)', text, re.S)
+    if call:
+        operation = call.group(1)
+        if operation not in EXPRESSION_OPERATIONS:
+            raise ValueError(f'operação desconhecida: {operation}')
+        args = [parse_expression(argument) for argument in split_arguments(call.group(2))]
+        return {
+            'kind': 'operation',
+            'operation': operation,
+            'args': args,
+            'key': f"{operation}({','.join(arg['key'] for arg in args)})"
+        }
+    if re.fullmatch(r'\$\w+', text):
+        return {'kind': 'variable', 'name': text[1:], 'key': text}
+    if re.fullmatch(r'@[A-Za-z]{1,3}[0-9]+', text):
+        coordinate = text[1:].upper()
+        return {'kind': 'cell', 'coordinate': coordinate, 'key': f'@{coordinate}'}
+    if re.fullmatch(r'-?\d+([.,]\d+)?', text):
+        value = float(text.replace(',', '.'))
+        return {'kind': 'constant', 'value': value, 'key': repr(value)}
+    
+    aggregate = parse_aggregate(text) if text else None
+    if aggregate is None:
+        raise ValueError(f'expressão não reconhecida: {text}')
+    if aggregate['operation'] not in AGGREGATE_OPERATIONS:
+        raise ValueError(f"operação de agregação desconhecida: {aggregate['operation']}")
+    key = f"{aggregate['table_name']}.{aggregate['field_name']}.{aggregate['operation']}"
+    if aggregate['group_field']:
+        key += f".{aggregate['group_field']}={aggregate['group_value']}"
+    return dict(aggregate, kind='aggregate', key=key)
+
+def expression_nodes(node):
+    """Percorre todos os nós da árvore de expressão"""
+    yield node
+    for arg in node.get('args', ()):
+        yield from expression_nodes(arg)
+
+def compile_calculations(calculations):
+    """Valida as referências entre as células de cálculo e retorna a ordem de avaliação.
+
+    As dependências formam um grafo acíclico; a ordem é topológica, de modo que cada
+    célula é avaliada depois das células que ela referencia.
+    """
+    dependencies = {}
+    for coord, calc_info in calculations.items():
+        references = {node['coordinate'] for node in expression_nodes(calc_info['expression'])
+                      if node['kind'] == 'cell'}
+        for reference in references:
+            if reference not in calculations:
+                raise TemplateError(f'Cálculo em {coord} referencia @{reference}, que não é uma célula de cálculo')
+        dependencies[coord] = sorted(references)
+    
+    # Busca em profundidade iterativa, detectando ciclos pelo caminho em visita
+    order = []
+    visited = set()
+    for root in sorted(dependencies):
+        if root in visited:
+            continue
+        path = [root]
+        pending = [iter(dependencies[root])]
+        visiting = {root}
+        while pending:
+            for reference in pending[-1]:
+                if reference in visiting:
+                    cycle = path[path.index(reference):] + [reference]
+                    raise TemplateError(f'Referência circular entre os cálculos: {" -> ".join(cycle)}')
+                if reference not in visited:
+                    path.append(reference)
+                    pending.append(iter(dependencies[reference]))
+                    visiting.add(reference)
+                    break
+            else:
+                coord = path.pop()
+                pending.pop()
+                visiting.discard(coord)
+                visited.add(coord)
+                order.append(coord)
+    return order
+
+def evaluate_expression(node, aggregate_results, variables, cell_results, memo):
+    """Avalia um nó da expressão; o resultado de cada subexpressão é calculado uma única vez.
+
+    Retorna None quando um agregado não tem valores; levanta ValueError quando a
+    expressão não pode ser calculada com os dados enviados.
+    """
+    key = node['key']
+    if key in memo:
+        return memo[key]
+    
+    kind = node['kind']
+    if kind == 'aggregate':
+        result = aggregate_results.get(aggregate_key(node))
+    elif kind == 'constant':
+        result = node['value']
+    elif kind == 'variable':
+        if node['name'] not in variables:
+            raise ValueError(f"a variável ${node['name']} não foi enviada ou não é numérica")
+        result = variables[node['name']]
+    elif kind == 'cell':
+        result = cell_results.get(node['coordinate'])
+    else:
+        values = [evaluate_expression(arg, aggregate_results, variables, cell_results, memo) for arg in node['args']]
+        if any(value is None for value in values):
+            result = None
+        elif any(not isinstance(value, (int, float)) for value in values):
+            raise ValueError(f"{node['operation']} aceita apenas valores numéricos")
+        else:
+            result = values[0]
+            for value in values[1:]:
+                if node['operation'] == 'somar':
+                    result += value
+                elif node['operation'] == 'subtrair':
+                    result -= value
+                elif node['operation'] == 'multiplicar':
+                    result *= value
+                elif node['operation'] == 'dividir':
+                    result = result / value if value != 0 else 0
+    
+    memo[key] = result
+    return result
+
+# Operações de agregação das tabelas e as funções equivalentes do pandas
+AGGREGATE_OPERATIONS = {
+    'somar': 'sum',
+    'media': 'mean',
+    'min': 'min',
+    'max': 'max',
+    'mediana': 'median',
+    'contar': 'count'
+}
+
+def parse_aggregate(expression):
+    """Interpreta tabela.campo.operação, com o filtro opcional .campo_grupo=valor para subtotais"""
+    parts = expression.strip().split('.', 3)
+    if len(parts) < 3:
+        return None
+    aggregate = {
+        'operation': parts[2],
+        'table_name': parts[0],
+        'field_name': parts[1],
+        'group_field': None,
+        'group_value': None
+    }
+    if len(parts) == 4:
+        group_field, separator, group_value = parts[3].partition('=')
+        if not separator:
+            return None
+        aggregate['group_field'] = group_field.strip()
+        aggregate['group_value'] = group_value.strip()
+    return aggregate
+
+def aggregate_key(aggregate):
+    return (aggregate['table_name'], aggregate['field_name'], aggregate['operation'],
+            aggregate.get('group_field'), aggregate.get('group_value'))
+
+def compute_aggregates(data, aggregates):
+    """Calcula os agregados a partir das colunas do payload, com uma passagem do pandas por tabela.
+
+    Retorna {aggregate_key: resultado}. 'contar' conta os valores preenchidos de qualquer
+    tipo, e min e max de um campo de data retornam a data. Sem nenhum valor no campo,
+    inclusive em um subtotal sem linhas do grupo, 'somar' vale 0 e as demais operações
+    valem None, exibido como célula vazia. Operações que não se aplicam aos valores
+    enviados, como a soma de um campo sem números, levantam PayloadError.
+    """
+    by_table = {}
+    for aggregate in aggregates:
+        if aggregate['operation'] in AGGREGATE_OPERATIONS:
+            by_table.setdefault(aggregate['table_name'], []).append(aggregate)
+    
+    results = {}
+    errors = []
+    for table_name, table_aggregates in by_table.items():
+        rows = data.get(table_name)
+        fields = sorted({aggregate['field_name'] for aggregate in table_aggregates})
+        group_fields = sorted({aggregate['group_field'] for aggregate in table_aggregates if aggregate['group_field']})
+        columns = sorted(set(fields) | set(group_fields))
+        if isinstance(rows, TableStream):
+            # Tabela enviada em arquivo: usa as colunas guardadas na validação, sem reler o arquivo
+            frame = rows.columns_frame(columns)
+        else:
+            rows = [row for row in rows if isinstance(row, dict)] if isinstance(rows, list) else []
+            frame = pd.DataFrame.from_records(rows, columns=columns)
+        
+        # Datas já convertidas na validação entram só em min, max e contar; nos demais campos,
+        # valores não numéricos são ignorados como células em branco
+        date_fields = [field for field in fields if pd.api.types.is_datetime64_any_dtype(frame[field])]
+        number_fields = [field for field in fields if field not in date_fields]
+        values = pd.concat([frame[number_fields].astype(object).apply(pd.to_numeric, errors='coerce'),
+                            frame[date_fields]], axis=1)
+        functions = {field: {'count'} for field in fields}
+        for aggregate in table_aggregates:
+            function = AGGREGATE_OPERATIONS[aggregate['operation']]
+            if aggregate['field_name'] in date_fields and function not in ('min', 'max', 'count'):
+                errors.append(f"Não é possível calcular {aggregate['operation']} de {table_name}."
+                              f"{aggregate['field_name']}: o campo contém datas")
+                continue
+            functions[aggregate['field_name']].add(function)
+        functions = {field: sorted(field_functions) for field, field_functions in functions.items()}
+        totals = {None: (values.agg(functions), frame[fields].count())}
+        for group_field in group_fields:
+            keys = frame[group_field].astype(str)
+            totals[group_field] = (values.groupby(keys).agg(functions), frame[fields].groupby(keys).count())
+        
+        for aggregate in table_aggregates:
+            field = aggregate['field_name']
+            function = AGGREGATE_OPERATIONS[aggregate['operation']]
+            if function not in functions[field]:
+                continue
+            summary, filled = totals[aggregate['group_field']]
+            if aggregate['group_field']:
+                group_value = aggregate['group_value']
+                if group_value in summary.index:
+                    numeric_count = summary.loc[group_value, (field, 'count')]
+                    value = summary.loc[group_value, (field, function)]
+                    filled_count = filled.loc[group_value, field]
+                else:
+                    numeric_count = value = filled_count = 0
+            else:
+                numeric_count = summary.loc['count', field]
+                value = summary.loc[function, field]
+                filled_count = filled[field]
+            
+            if function == 'count':
+                results[aggregate_key(aggregate)] = int(filled_count)
+            elif not filled_count:
+                results[aggregate_key(aggregate)] = 0.0 if function == 'sum' else None
+            elif not numeric_count or pd.isna(value):
+                errors.append(f"Não é possível calcular {aggregate['operation']} de {table_name}.{field}: "
+                              f"o campo não tem valores numéricos")
+            elif field in date_fields:
+                results[aggregate_key(aggregate)] = value.to_pydatetime()
+            else:
+                results[aggregate_key(aggregate)] = float(value)
+    
+    if errors:
+        raise payload_error(errors)
+    return results
+
+def evaluate_calculations(plan, data):
+    """Calcula o resultado das células %[...] de cada aba a partir do payload validado.
+
+    Os cálculos não dependem do modelo carregado, então um valor que não pode ser
+    calculado com os dados enviados, como um $nome ausente, é recusado com PayloadError
+    antes de qualquer acesso ao workbook. Retorna {aba: {coordenada: resultado}}; None
+    indica um agregado sem valores, exibido como célula vazia.
+    """
+    if not isinstance(data, dict):
+        raise PayloadError('O payload deve ser um objeto JSON')
+    
+    # Valores numéricos disponíveis para as expressões ($nome) de qualquer aba
+    variables = {name: value for name, value in data.items()
+                 if isinstance(value, (int, float)) and not isinstance(value, bool)}
+    
+    errors = []
+    results = {}
+    for title, sheet_plan in plan['sheets'].items():
+        try:
+            aggregate_results = compute_aggregates(data, sheet_plan['aggregates'])
+        except PayloadError as e:
+            errors.extend(e.errors)
+            continue
+        
+        # Avalia os cálculos na ordem das dependências
+        cell_results = {}
+        memo = {}
+        for coord in sheet_plan['calculation_order']:
+            calc_info = sheet_plan['calculations'][coord]
+            try:
+                cell_results[coord] = evaluate_expression(calc_info['expression'], aggregate_results, variables,
+                                                          cell_results, memo)
+            except (ValueError, TypeError, ArithmeticError) as e:
+                errors.append(f"Não foi possível calcular {calc_info['original_text']} em {title}!{coord}: {str(e)}")
+                cell_results[coord] = None
+        results[title] = cell_results
+    
+    if errors:
+        # Agregados usados em mais de uma aba repetiriam o mesmo erro
+        raise payload_error(list(dict.fromkeys(errors)))
+    return results
+
+def analyze_template(filepath):
+    """Analisa o modelo XLSX e retorna as informações do modelo e o plano de renderização.
+
+    O plano guarda, para cada aba com marcadores, as posições já convertidas para
+    índices numéricos, as células de cálculo interpretadas e a formatação da linha
+    modelo de cada tabela, para que a geração apenas aplique os dados.
+    """
+    # Somente leitura: a análise não precisa montar o modelo de objetos completo
+    wb = load_workbook(filepath, read_only=True)
+    try:
+        model_info = {
+            'sheets': {},
+            'variables': [],
+            'tables': []
+        }
+        plan = {
+            'version': file_version(filepath),
+            'sheets': {}
+        }
+        
+        for sheet in wb.worksheets:
+            try:
+                sheet_info, sheet_plan = analyze_sheet(sheet)
+            except TemplateError as e:
+                raise TemplateError(f'Aba {sheet.title}: {str(e)}')
+            
+            # Abas sem marcadores são mantidas no documento, mas não precisam de preenchimento
+            if not (sheet_plan['variables'] or sheet_plan['tables'] or sheet_plan['calculations']):
+                continue
+            model_info['sheets'][sheet.title] = sheet_info
+            plan['sheets'][sheet.title] = sheet_plan
+            
+            # Variáveis e campos de todas as abas, usados no exemplo de payload
+            for key in ('variables', 'tables'):
+                model_info[key].extend(dict(item, sheet=sheet.title) for item in sheet_info[key])
+        
+        plan['validator'] = compile_validator(model_info, plan)
+        return model_info, plan
+    finally:
+        wb.close()
+
+def compile_validator(model_info, plan):
+    """Compila o esquema do payload a partir dos tipos dos marcadores do modelo.
+
+    Retorna {'variables': {nome: tipo}, 'tables': {tabela: {campo: tipo}},
+    'aggregate_columns': {tabela: [campos]}}. Quando o mesmo nome aparece em mais de uma
+    aba, vale o tipo da primeira declaração. aggregate_columns lista os campos usados nos
+    agregados, guardados pela validação das tabelas recebidas em arquivo.
+    """
+    validator = {
+        'variables': {},
+        'tables': {},
+        'aggregate_columns': {}
+    }
+    for var in model_info['variables']:
+        validator['variables'].setdefault(var['name'], var['type'])
+    for field in model_info['tables']:
+        validator['tables'].setdefault(field['name'], {}).setdefault(field['field'], field['type'])
+    columns = {}
+    for sheet_plan in plan['sheets'].values():
+        for aggregate in sheet_plan['aggregates']:
+            table_columns = columns.setdefault(aggregate['table_name'], set())
+            table_columns.add(aggregate['field_name'])
+            if aggregate['group_field']:
+                table_columns.add(aggregate['group_field'])
+    validator['aggregate_columns'] = {table_name: sorted(table_columns) for table_name, table_columns in columns.items()}
+    return validator
+
+def analyze_sheet(sheet):
+    """Analisa uma aba do modelo e retorna as informações e o plano de renderização da aba"""
+    # Inicializa as informações da aba
+    sheet_info = {
+        'variables': [],
+        'tables': []
+    }
+    sheet_plan = {
+        'variables': [],
+        'tables': {},
+        'calculations': {},
+        'calculation_order': [],
+        'aggregates': []
+    }
+    
+    # Procura por células com marcadores especiais
+    for row in sheet.iter_rows():
+        for cell in row:
+            if cell.value and isinstance(cell.value, str):
+                # Procura por variáveis (formato: ${nome:tipo})
+                var_matches = re.finditer(r'\${([^:]+):([^}]+)}', cell.value)
+                for match in var_matches:
+                    name, type_info = match.groups()
+                    sheet_info['variables'].append({
+                        'name': name,
+                        'type': type_info,
+                        'cell': cell.coordinate
+                    })
+                    sheet_plan['variables'].append({
+                        'name': name,
+                        'type': type_info,
+                        'row': cell.row,
+                        'column': cell.column
+                    })
+                
+                # Procura por tabelas (formato: #{tabela.campo:tipo})
+                table_matches = re.finditer(r'#{([^.]+)\.([^:]+):([^}]+)}', cell.value)
+                for match in table_matches:
+                    table_name, field, type_info = match.groups()
+                    sheet_info['tables'].append({
+                        'name': table_name,
+                        'field': field,
+                        'type': type_info,
+                        'start_cell': cell.coordinate
+                    })
+                    table = sheet_plan['tables'].setdefault(table_name, {
+                        'start_row': cell.row,
+                        'fields': []
+                    })
+                    table['fields'].append({
+                        'field': field,
+                        'type': type_info,
+                        'column': cell.column
+                    })
+                
+                # Procura por cálculos (formato: %{tabela.campo:operação})
+                calc_matches = re.finditer(r'%{([^}]+)}', cell.value)
+                for match in calc_matches:
+                    calc_expression = match.group(1)
+                    # Divide a expressão em tabela.campo:operação
+                    parts = calc_expression.split(':')
+                    if len(parts) != 2:
+                        continue
+                    
+                    field_parts = parts[0].split('.')
+                    if len(field_parts) != 2:
+                        continue
+                    
+                    sheet_info['calculations'] = sheet_info.get('calculations', [])
+                    sheet_info['calculations'].append({
+                        'table_name': field_parts[0],
+                        'field_name': field_parts[1],
+                        'operation': parts[1],
+                        'cell': cell.coordinate
+                    })
+                
+                # Procura por cálculos no formato %[...]
+                calc_info = parse_calculation(cell)
+                if calc_info:
+                    sheet_plan['calculations'][cell.coordinate] = calc_info
+    
+    # Resolve a coluna e o tipo do campo de cada cálculo simples
+    for calc_info in sheet_plan['calculations'].values():
+        if calc_info['type'] == 'simple':
+            table = sheet_plan['tables'].get(calc_info['table_name'], {})
+            for field in table.get('fields', []):
+                if field['field'] == calc_info['field_name']:
+                    calc_info['target_column'] = field['column']
+                    calc_info['field_type'] = field['type']
+                    break
+    
+    # Ordem de avaliação dos cálculos e agregados distintos usados pelas expressões
+    sheet_plan['calculation_order'] = compile_calculations(sheet_plan['calculations'])
+    aggregates = {}
+    for calc_info in sheet_plan['calculations'].values():
+        for node in expression_nodes(calc_info['expression']):
+            if node['kind'] == 'aggregate':
+                aggregates.setdefault(node['key'], node)
+    sheet_plan['aggregates'] = list(aggregates.values())
+    
+    for table in sheet_plan['tables'].values():
+        start_row = table['start_row']
+        
+        # Salva a formatação da linha modelo como identificadores de estilo, que valem
+        # para qualquer cópia do mesmo arquivo e são compartilhados pelas linhas novas
+        table['template_styles'] = {}
+        template_row = next(sheet.iter_rows(min_row=start_row, max_row=start_row), ())
+        for column, cell in enumerate(template_row, start=1):
+            table['template_styles'][column] = StyleArray(getattr(cell, 'style_array', None) or StyleArray())
+
+    return sheet_info, sheet_plan
+
+def open_model_index():
+    """Abre o índice persistido dos modelos, recriando-o se o formato mudou"""
+    connection = sqlite3.connect(app.config['MODEL_INDEX_PATH'], timeout=30)
+    if connection.execute('PRAGMA user_version').fetchone()[0] != MODEL_INDEX_FORMAT:
+        connection.execute('DROP TABLE IF EXISTS model_index')
+        connection.execute(f'PRAGMA user_version = {MODEL_INDEX_FORMAT}')
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS model_index (
+            filename TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            version TEXT NOT NULL,
+            model_info TEXT NOT NULL,
+            plan BLOB NOT NULL
+        )
+    """)
+    return connection
+
+def template_version_path(version):
+    """Caminho da cópia imutável de uma versão do modelo"""
+    return os.path.join(app.config['TEMPLATE_VERSIONS_FOLDER'], f'{version}.xlsx')
+
+def store_template_version(source):
+    """Copia o conteúdo de um arquivo aberto para uma versão imutável do modelo.
+
+    O hash é calculado sobre os bytes copiados, então o nome da versão sempre
+    corresponde ao conteúdo, mesmo que o arquivo de origem esteja sendo alterado.
+    Retorna (caminho, versão).
+    """
+    folder = app.config['TEMPLATE_VERSIONS_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    temp_path = os.path.join(folder, f'.{uuid.uuid4().hex}.tmp')
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        version = digest.hexdigest()
+        version_path = template_version_path(version)
+        if os.path.exists(version_path):
+            # Versão já guardada: renova a data para que a limpeza não a remova agora
+            os.remove(temp_path)
+            os.utime(version_path)
+        else:
+            os.replace(temp_path, version_path)
+        return version_path, version
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def import_template(filepath):
+    """Guarda o modelo como uma nova versão imutável e analisa essa cópia"""
+    with open(filepath, 'rb') as f:
+        version_path, _ = store_template_version(f)
+    return analyze_template(version_path)
+
+def publish_template(version_path, filepath):
+    """Substitui o arquivo em uploads/ por uma cópia da versão, de forma atômica"""
+    temp_path = os.path.join(os.path.dirname(filepath), f'.{uuid.uuid4().hex}.tmp')
+    shutil.copyfile(version_path, temp_path)
+    os.replace(temp_path, filepath)
+
+def retire_template_version(version):
+    """Marca a versão como substituída; ela é removida após TEMPLATE_VERSION_GRACE"""
+    try:
+        os.utime(template_version_path(version))
+    except OSError:
+        pass
+
+def prune_template_versions():
+    """Remove as versões que não estão publicadas e foram substituídas há mais tempo que o prazo"""
+    folder = app.config['TEMPLATE_VERSIONS_FOLDER']
+    if not os.path.exists(folder):
+        return
+    published = {f"{plan['version']}.xlsx" for plan in list(app.config['RENDER_PLANS'].values())}
+    limit = time.time() - app.config['TEMPLATE_VERSION_GRACE']
+    for name in os.listdir(folder):
+        if name in published:
+            continue
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+                print(f"Versão antiga de modelo removida: {name}")
+        except OSError:
+            pass
+
+def register_model(filename, model_info, plan, stat=None):
+    """Publica o modelo analisado e grava a análise no índice persistido.
+
+    A troca é feita substituindo a entrada de RENDER_PLANS, que aponta para uma
+    versão imutável; as requisições em andamento seguem com o plano que já obtiveram.
+    """
+    previous = app.config['RENDER_PLANS'].get(filename)
+    app.config['RENDER_PLANS'][filename] = plan
+    app.config['MODEL_INFO'][filename] = model_info
+    app.config['PENDING_MODELS'].discard(filename)
+    app.config['MODEL_CATALOG'].invalidate(filename)
+    if previous and previous['version'] != plan['version']:
+        retire_template_version(previous['version'])
+    
+    try:
+        stat = stat or os.stat(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        with closing(open_model_index()) as connection, connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO model_index VALUES (?, ?, ?, ?, ?, ?)',
+                (filename, stat.st_mtime_ns, stat.st_size, plan['version'],
+                 json.dumps(model_info), pickle.dumps(plan, protocol=pickle.HIGHEST_PROTOCOL)))
+    except Exception as e:
+        print(f"Erro ao atualizar índice do modelo {filename}: {str(e)}")
+
+def unregister_model(filename):
+    """Remove o modelo da memória e do índice persistido"""
+    previous = app.config['RENDER_PLANS'].pop(filename, None)
+    app.config['MODEL_INFO'].pop(filename, None)
+    app.config['PENDING_MODELS'].discard(filename)
+    app.config['MODEL_CATALOG'].invalidate(filename)
+    if previous:
+        retire_template_version(previous['version'])
+    try:
+        with closing(open_model_index()) as connection, connection:
+            connection.execute('DELETE FROM model_index WHERE filename = ?', (filename,))
+    except Exception as e:
+        print(f"Erro ao atualizar índice do modelo {filename}: {str(e)}")
+
+def ensure_model(filename):
+    """Retorna o plano da versão publicada do modelo, analisando-o agora se ainda não foi indexado.
+
+    O chamador deve usar esse mesmo plano até o fim da requisição: ele aponta para uma
+    versão imutável do modelo, que continua disponível mesmo após uma nova publicação.
+    """
+    plan = app.config['RENDER_PLANS'].get(filename)
+    if plan is not None:
+        return plan
+    if filename not in app.config['PENDING_MODELS']:
+        return None
+    
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.exists(filepath):
+        app.config['PENDING_MODELS'].discard(filename)
+        return None
+    try:
+        model_info, plan = import_template(filepath)
+        with app.config['MODEL_LOCK']:
+            # Pode ter sido publicado por outra requisição ou pelo observador nesse meio tempo
+            if filename not in app.config['PENDING_MODELS']:
+                return app.config['RENDER_PLANS'].get(filename)
+            register_model(filename, model_info, plan)
+        print(f"Modelo carregado sob demanda: {filename}")
+        return plan
+    except Exception as e:
+        print(f"Erro ao carregar modelo {filename}: {str(e)}")
+        return None
+
+def refresh_model(filename):
+    """Publica a versão atual de uploads/<arquivo>, se ela mudou; chamado pelo observador.
+
+    A nova versão é copiada e analisada antes da troca. Se o arquivo mudar de novo
+    durante a análise, a troca é descartada e o próximo evento refaz o trabalho; um
+    modelo inválido mantém a versão anterior publicada.
+    """
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    try:
+        before = os.stat(filepath)
+        with open(filepath, 'rb') as f:
+            version_path, version = store_template_version(f)
+    except FileNotFoundError:
+        with app.config['MODEL_LOCK']:
+            if not os.path.exists(filepath) and (filename in app.config['RENDER_PLANS']
+                                                 or filename in app.config['PENDING_MODELS']):
+                unregister_model(filename)
+                app.config['TEMPLATE_CACHE'].invalidate(filename)
+                print(f"Modelo removido: {filename}")
+        return
+    
+    current = app.config['RENDER_PLANS'].get(filename)
+    if current and current['version'] == version:
+        return
+    try:
+        model_info, plan = analyze_template(version_path)
+    except Exception as e:
+        print(f"Erro ao recarregar modelo {filename}, mantida a versão anterior: {str(e)}")
+        return
+    
+    with app.config['MODEL_LOCK']:
+        try:
+            after = os.stat(filepath)
+        except FileNotFoundError:
+            return
+        if (after.st_mtime_ns, after.st_size) != (before.st_mtime_ns, before.st_size):
+            return
+        register_model(filename, model_info, plan, stat=after)
+    print(f"Modelo publicado: {filename} (versão {version[:12]})")
+
+class TemplateWatcher:
+    """Observa UPLOAD_FOLDER e publica em segundo plano os modelos alterados.
+
+    No Linux usa inotify (via ctypes); sem ele, compara mtime e tamanho dos arquivos a
+    cada TEMPLATE_WATCH_INTERVAL segundos. Os eventos de um arquivo esperam
+    TEMPLATE_WATCH_DEBOUNCE segundos sem novas alterações antes da análise, e a mesma
+    thread remove periodicamente as versões antigas dos modelos.
+    """
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, folder, interval, debounce):
+        self.folder = folder
+        self.interval = interval
+        self.debounce = debounce
+        self.fd = None
+        self.pending = {}  # arquivo -> instante do último evento
+        self.snapshot = {}
+
+    def start(self):
+        self.fd = self._open_inotify()
+        if self.fd is None:
+            self.snapshot = self._scan()
+        print(f"Observando {self.folder} ({'inotify' if self.fd is not None else 'verificação periódica'})")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _open_inotify(self):
+        """Abre um descritor inotify para a pasta ou retorna None se não houver suporte"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(os.path.abspath(self.folder)), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def _is_template(self, name):
+        return name.endswith('.xlsx') and not name.startswith('.')
+
+    def _scan(self):
+        snapshot = {}
+        for entry in os.scandir(self.folder):
+            if self._is_template(entry.name):
+                try:
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+        return snapshot
+
+    def _read_events(self):
+        """Lê os eventos disponíveis e retorna os nomes dos arquivos alterados"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Eventos perdidos: confere todos os modelos
+                names.update(self._scan())
+                names.update(app.config['RENDER_PLANS'])
+            elif self._is_template(name):
+                names.add(name)
+        return names
+
+    def _changed(self):
+        if self.fd is not None:
+            timeout = self.debounce if self.pending else app.config['JANITOR_INTERVAL']
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            return self._read_events() if readable else set()
+        
+        time.sleep(self.debounce if self.pending else self.interval)
+        current = self._scan()
+        names = {name for name in set(current) | set(self.snapshot) if current.get(name) != self.snapshot.get(name)}
+        self.snapshot = current
+        return names
+
+    def _run(self):
+        last_prune = 0
+        while True:
+            try:
+                now = time.monotonic()
+                for name in self._changed():
+                    self.pending[name] = now
+                
+                now = time.monotonic()
+                for name in [name for name, changed in self.pending.items() if now - changed >= self.debounce]:
+                    del self.pending[name]
+                    refresh_model(name)
+                
+                if now - last_prune >= app.config['JANITOR_INTERVAL']:
+                    prune_template_versions()
+                    last_prune = now
+            except Exception as e:
+                print(f"Erro ao observar modelos: {str(e)}")
+                time.sleep(self.interval)
+
+def scan_pending_models(futures):
+    """Recebe em segundo plano as análises feitas pelo pool de processos"""
+    for future in as_completed(futures):
+        filename = futures[future]
+        try:
+            model_info, plan = future.result()
+            # Pode já ter sido analisado sob demanda, recarregado ou removido nesse meio tempo
+            with app.config['MODEL_LOCK']:
+                if filename not in app.config['PENDING_MODELS']:
+                    continue
+                register_model(filename, model_info, plan)
+            print(f"Modelo carregado: {filename}")
+        except Exception as e:
+            app.config['PENDING_MODELS'].discard(filename)
+            print(f"Erro ao carregar modelo {filename}: {str(e)}")
+    print("Carregamento de modelos concluído")
 
 def load_xlsx_models():
-    """Carrega todos os modelos XLSX da pasta uploads ao iniciar a aplicação"""
+    """Carrega os modelos XLSX da pasta uploads ao iniciar a aplicação.
+
+    Modelos inalterados (mesmo mtime e tamanho, ou mesmo hash) vêm do índice
+    persistido; os demais são analisados em paralelo em segundo plano, ou sob
+    demanda no primeiro uso.
+    """
     try:
         if not os.path.exists(app.config['UPLOAD_FOLDER']):
             os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -35,273 +1662,1257 @@ def load_xlsx_models():
             return
         
         print("Carregando modelos XLSX...")
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            if filename.endswith('.xlsx'):
+        filenames = {filename for filename in os.listdir(app.config['UPLOAD_FOLDER']) if filename.endswith('.xlsx')}
+        
+        with closing(open_model_index()) as connection, connection:
+            for filename, mtime_ns, size, version, model_info, plan in connection.execute(
+                    'SELECT filename, mtime_ns, size, version, model_info, plan FROM model_index'):
+                if filename not in filenames:
+                    connection.execute('DELETE FROM model_index WHERE filename = ?', (filename,))
+                    continue
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                 try:
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    wb = load_workbook(filepath)
-                    sheet = wb.active
-                    
-                    # Inicializa as informações do modelo
-                    model_info = {
-                        'variables': [],
-                        'tables': []
-                    }
-                    
-                    # Procura por células com marcadores especiais
-                    for row in sheet.iter_rows():
-                        for cell in row:
-                            if cell.value and isinstance(cell.value, str):
-                                # Procura por variáveis (formato: ${nome:tipo})
-                                var_matches = re.finditer(r'\${([^:]+):([^}]+)}', cell.value)
-                                for match in var_matches:
-                                    name, type_info = match.groups()
-                                    model_info['variables'].append({
-                                        'name': name,
-                                        'type': type_info,
-                                        'cell': cell.coordinate
-                                    })
-                                
-                                # Procura por tabelas (formato: #{tabela.campo:tipo})
-                                table_matches = re.finditer(r'#{([^.]+)\.([^:]+):([^}]+)}', cell.value)
-                                for match in table_matches:
-                                    table_name, field, type_info = match.groups()
-                                    model_info['tables'].append({
-                                        'name': table_name,
-                                        'field': field,
-                                        'type': type_info,
-                                        'start_cell': cell.coordinate
-                                    })
-                                
-                                # Procura por cálculos (formato: %{operacao})
-                                calc_matches = re.finditer(r'%{([^}]+)}', cell.value)
-                                for match in calc_matches:
-                                    calc_expression = match.group(1)
-                                    # Divide a expressão em tabela.campo:operação
-                                    parts = calc_expression.split(':')
-                                    if len(parts) != 2:
-                                        continue
-                                    
-                                    field_parts = parts[0].split('.')
-                                    if len(field_parts) != 2:
-                                        continue
-                                    
-                                    table_name = field_parts[0]
-                                    field_name = field_parts[1]
-                                    operation = parts[1]
-                                    
-                                    model_info['calculations'] = model_info.get('calculations', [])
-                                    model_info['calculations'].append({
-                                        'table_name': table_name,
-                                        'field_name': field_name,
-                                        'operation': operation,
-                                        'cell': cell.coordinate
-                                    })
-                    
-                    # Armazena as informações do modelo
-                    app.config['MODEL_INFO'][filename] = model_info
-                    print(f"Modelo carregado: {filename}")
-                    wb.close()
-                
+                    stat = os.stat(filepath)
+                    unchanged = stat.st_mtime_ns == mtime_ns and stat.st_size == size
+                    if not unchanged and stat.st_size == size and file_version(filepath) == version:
+                        # Conteúdo igual com data diferente: só atualiza o índice
+                        connection.execute('UPDATE model_index SET mtime_ns = ? WHERE filename = ?',
+                                           (stat.st_mtime_ns, filename))
+                        unchanged = True
+                    if unchanged and not os.path.exists(template_version_path(version)):
+                        # Índice anterior às versões imutáveis: guarda a versão em uso
+                        with open(filepath, 'rb') as f:
+                            unchanged = store_template_version(f)[1] == version
+                    if unchanged:
+                        app.config['MODEL_INFO'][filename] = json.loads(model_info)
+                        app.config['RENDER_PLANS'][filename] = pickle.loads(plan)
                 except Exception as e:
-                    print(f"Erro ao carregar modelo {filename}: {str(e)}")
+                    print(f"Erro ao ler índice do modelo {filename}: {str(e)}")
+        
+        pending = filenames - set(app.config['MODEL_INFO'])
+        print(f"{len(filenames) - len(pending)} modelos carregados do índice, {len(pending)} para analisar")
+        if not pending:
+            print("Carregamento de modelos concluído")
+            return
         
-        print("Carregamento de modelos concluído")
+        # Analisa os modelos novos ou alterados em paralelo, sem bloquear a inicialização
+        app.config['PENDING_MODELS'].update(pending)
+        max_workers = min(len(pending), os.cpu_count() or 1)
+        if 'fork' in multiprocessing.get_all_start_methods():
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            # Sem fork os processos reimportariam a aplicação; usa threads
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {
+            executor.submit(import_template, os.path.join(app.config['UPLOAD_FOLDER'], filename)): filename
+            for filename in sorted(pending)
+        }
+        executor.shutdown(wait=False)
+        threading.Thread(target=scan_pending_models, args=(futures,), daemon=True).start()
     
     except Exception as e:
         print(f"Erro ao carregar modelos: {str(e)}")
 
+def load_model_settings():
+    """Carrega as configurações por modelo (como o motor de renderização)"""
+    settings_path = os.path.join(app.config['UPLOAD_FOLDER'], 'model_settings.json')
+    if os.path.exists(settings_path):
+        try:
+            with open(settings_path, encoding='utf-8') as f:
+                app.config['MODEL_SETTINGS'] = json.load(f)
+        except Exception as e:
+            print(f"Erro ao carregar configurações dos modelos: {str(e)}")
+
+def save_model_settings():
+    """Grava as configurações por modelo de forma atômica"""
+    settings_path = os.path.join(app.config['UPLOAD_FOLDER'], 'model_settings.json')
+    temp_path = unique_temp_path(settings_path)
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(app.config['MODEL_SETTINGS'], f, indent=2)
+    os.replace(temp_path, settings_path)
+
+def build_example_payload(model_info):
+    """Cria um exemplo de payload baseado nas informações do modelo"""
+    example_values = {'text': 'Exemplo {}', 'int': 123, 'double': 123.45, 'date': '11-03-2024'}
+    
+    def example_value(field_type, name):
+        value = example_values[field_type]
+        return value.format(name) if field_type == 'text' else value
+    
+    example_payload = {}
+    
+    # Adiciona exemplos para variáveis simples
+    for var in model_info.get('variables', []):
+        if var['type'] in example_values:
+            example_payload[var['name']] = example_value(var['type'], var['name'])
+    
+    # Organiza campos por tabela
+    tables = {}
+    for table in model_info.get('tables', []):
+        tables.setdefault(table['name'], []).append(table)
+    
+    # Adiciona dois exemplos de linha para cada tabela
+    for table_name, fields in tables.items():
+        example_row = {field['field']: example_value(field['type'], field['field'])
+                       for field in fields if field['type'] in example_values}
+        example_payload[table_name] = [example_row, dict(example_row)]
+    
+    return example_payload
+
+class ModelCatalog:
+    """Catálogo dos modelos (esquema e exemplo de payload), calculado uma vez por versão.
+
+    As entradas são refeitas só quando o modelo muda: register_model/unregister_model
+    e a alteração das configurações chamam invalidate. A listagem ordenada e o seu
+    ETag, derivado das versões e configurações, ficam guardados até a próxima mudança.
+    """
+    
+    def __init__(self):
+        self.entries = {}  # arquivo -> entrada do catálogo
+        self.listing = None  # (entradas ordenadas, etag)
+        self.generation = 0  # Muda a cada invalidação
+        self.lock = threading.Lock()
+    
+    def invalidate(self, filename):
+        with self.lock:
+            self.entries.pop(filename, None)
+            self.listing = None
+            self.generation += 1
+    
+    def build_entry(self, filename):
+        model_info = app.config['MODEL_INFO'].get(filename)
+        plan = app.config['RENDER_PLANS'].get(filename)
+        settings = app.config['MODEL_SETTINGS'].get(filename, {})
+        return {
+            'name': filename,
+            'model': filename[:-5],
+            'version': plan['version'] if plan else None,
+            'pending': model_info is None,
+            'engine': settings.get('engine') if settings.get('engine') in RENDER_ENGINES else 'libreoffice',
+            'priority': settings.get('priority') if settings.get('priority') in PRIORITIES else 'normal',
+            'schema': model_info or {},
+            'example_payload': build_example_payload(model_info or {})
+        }
+    
+    def list(self):
+        """Entradas de todos os modelos em ordem de nome e o ETag da listagem"""
+        with self.lock:
+            if self.listing is not None:
+                return self.listing
+            generation = self.generation
+        
+        filenames = sorted(set(app.config['MODEL_INFO']) | set(app.config['PENDING_MODELS']))
+        entries = []
+        for filename in filenames:
+            with self.lock:
+                entry = self.entries.get(filename)
+            if entry is None:
+                entry = self.build_entry(filename)
+                with self.lock:
+                    if generation == self.generation:
+                        self.entries[filename] = entry
+            entries.append(entry)
+        
+        digest = hashlib.sha256()
+        for entry in entries:
+            digest.update(f"{entry['name']}|{entry['version']}|{entry['engine']}|{entry['priority']}\n".encode())
+        listing = (entries, digest.hexdigest())
+        with self.lock:
+            # Uma invalidação durante a montagem descarta esta listagem
+            if generation == self.generation:
+                self.listing = listing
+        return listing
+
+app.config['MODEL_CATALOG'] = ModelCatalog()
+
 # Garante que as pastas necessárias existem
-for folder in [app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER'], app.config['TEMP_FOLDER']]:
+for folder in [app.config['UPLOAD_FOLDER'], app.config['MODEL_STORE_FOLDER'], app.config['TEMPLATE_VERSIONS_FOLDER'],
+               app.config['DOWNLOAD_FOLDER'], app.config['TEMP_FOLDER'], app.config['SPOOL_FOLDER']]:
     os.makedirs(folder, exist_ok=True)
 
+# O índice ficava em uploads/, onde podia ser baixado; move-o para a pasta interna
+legacy_index_path = os.path.join(app.config['UPLOAD_FOLDER'], 'model_index.sqlite')
+if os.path.exists(legacy_index_path):
+    if os.path.exists(app.config['MODEL_INDEX_PATH']):
+        os.remove(legacy_index_path)
+    else:
+        os.replace(legacy_index_path, app.config['MODEL_INDEX_PATH'])
+
+# Assim como as versões dos modelos, guardadas antes em uploads/.versions
+legacy_versions_folder = os.path.join(app.config['UPLOAD_FOLDER'], '.versions')
+if os.path.isdir(legacy_versions_folder):
+    for name in os.listdir(legacy_versions_folder):
+        os.replace(os.path.join(legacy_versions_folder, name), os.path.join(app.config['TEMPLATE_VERSIONS_FOLDER'], name))
+    os.rmdir(legacy_versions_folder)
+
 # Carrega os modelos XLSX existentes
 load_xlsx_models()
+load_model_settings()
+
+# Publica em segundo plano os modelos alterados diretamente em uploads/
+app.config['TEMPLATE_WATCHER'] = TemplateWatcher(app.config['UPLOAD_FOLDER'], app.config['TEMPLATE_WATCH_INTERVAL'],
+                                                 app.config['TEMPLATE_WATCH_DEBOUNCE'])
+if app.config['TEMPLATE_WATCH']:
+    app.config['TEMPLATE_WATCHER'].start()
+
+# Inicia a limpeza dos arquivos temporários
+app.config['JANITOR'].start()
+
+# Localiza o executável do LibreOffice
+def find_soffice():
+    """Retorna o caminho do LibreOffice instalado ou None"""
+    if platform.system() != 'Linux':
+        return None
+    # Verifica os possíveis caminhos do LibreOffice no Ubuntu
+    soffice_paths = [
+        '/usr/bin/soffice',
+        '/usr/bin/libreoffice',
+        '/usr/lib/libreoffice/program/soffice',
+    ]
+    for path in soffice_paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+def uno_property(name, value):
+    """Cria um PropertyValue para as chamadas UNO"""
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+class OfficeInstance:
+    """Instância headless do LibreOffice com perfil próprio, reutilizada entre conversões"""
+
+    def __init__(self, index, soffice, slot=0):
+        self.index = index
+        self.soffice = soffice
+        # Porta e perfil dependem do slot do processo, para que vários workers não disputem a mesma instância
+        self.port = app.config['CONVERTER_BASE_PORT'] + slot * app.config['CONVERTER_POOL_SIZE'] + index
+        self.profile_dir = os.path.abspath(os.path.join(app.config['CONVERTER_PROFILE_FOLDER'], f'slot_{slot}',
+                                                        f'instance_{index}'))
+        self.process = None
+        self.desktop = None
+        self.busy_since = None
+        self.timed_out = False
+        self.lock = threading.Lock()
+
+    @property
+    def profile_url(self):
+        return Path(self.profile_dir).as_uri()
+
+    def start(self):
+        """Inicia o processo do LibreOffice e conecta via UNO"""
+        if not self.soffice:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if uno is None:
+            # Sem o módulo uno cada conversão usa o soffice em linha de comando,
+            # mas sempre com o perfil desta instância
+            return
+        self.process = subprocess.Popen([
+            self.soffice,
+            f'-env:UserInstallation={self.profile_url}',
+            '--headless',
+            '--invisible',
+            '--nologo',
+            '--norestore',
+            '--nodefault',
+            '--nolockcheck',
+            f'--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.desktop = self._connect()
+        print(f"LibreOffice {self.index} iniciado na porta {self.port}")
+
+    def _connect(self):
+        """Aguarda o LibreOffice aceitar conexões e retorna o Desktop"""
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        deadline = time.monotonic() + app.config['CONVERTER_START_TIMEOUT']
+        while True:
+            try:
+                context = resolver.resolve(
+                    f'uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext')
+                return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise Exception(f"LibreOffice {self.index} não respondeu na porta {self.port}")
+                time.sleep(0.2)
+
+    def stop(self):
+        """Encerra somente o processo desta instância"""
+        self.desktop = None
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+        self.process = None
+
+    def restart(self):
+        print(f"Reiniciando LibreOffice {self.index}")
+        self.stop()
+        self.start()
+
+    def is_healthy(self):
+        """Verifica se o processo está vivo e respondendo ao UNO"""
+        if uno is None or not self.soffice:
+            return True
+        if not self.process or self.process.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def _check_available(self):
+        if platform.system() != 'Linux':
+            raise Exception("Sistema operacional não suportado")
+        if not self.soffice:
+            raise Exception("LibreOffice não encontrado. Instale com: sudo apt-get install libreoffice")
+
+    def convert(self, excel_path, pdf_path):
+        """Converte o arquivo Excel para PDF nesta instância"""
+        self._check_available()
+
+        # Garante que o diretório de destino existe
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+
+        if uno is None:
+            temp_pdf, = self.convert_many([excel_path], os.path.dirname(pdf_path))
+            # Renomeia o arquivo
+            if os.path.exists(temp_pdf) and temp_pdf != pdf_path:
+                shutil.move(temp_pdf, pdf_path)
+            return
+
+        self._convert_uno(excel_path, pdf_path)
+
+    def convert_many(self, excel_paths, outdir):
+        """Converte vários arquivos Excel de uma vez e retorna os caminhos dos PDFs gerados"""
+        self._check_available()
+        os.makedirs(outdir, exist_ok=True)
+        pdf_paths = [os.path.join(outdir, os.path.splitext(os.path.basename(excel_path))[0] + '.pdf')
+                     for excel_path in excel_paths]
+
+        if uno is None:
+            # O soffice aceita vários arquivos de entrada na mesma chamada
+            subprocess.run([
+                self.soffice,
+                f'-env:UserInstallation={self.profile_url}',
+                '--headless',
+                '--convert-to', 'pdf:writer_pdf_Export',  # Usa o exportador PDF específico
+                '--outdir', outdir,
+            ] + list(excel_paths), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=app.config['CONVERSION_TIMEOUT'] * len(excel_paths))
+            return pdf_paths
+
+        for excel_path, pdf_path in zip(excel_paths, pdf_paths):
+            self._convert_uno(excel_path, pdf_path)
+        return pdf_paths
+
+    def _convert_uno(self, excel_path, pdf_path):
+        if not self.is_healthy():
+            self.restart()
+
+        self.busy_since = time.monotonic()
+        self.timed_out = False
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(excel_path)), '_blank', 0,
+                (uno_property('Hidden', True),))
+            try:
+                document.storeToURL(
+                    uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                    (uno_property('FilterName', 'calc_pdf_Export'),))
+            finally:
+                document.close(True)
+        except Exception:
+            if self.timed_out:
+                raise subprocess.TimeoutExpired(self.soffice, app.config['CONVERSION_TIMEOUT'])
+            raise
+        finally:
+            self.busy_since = None
+
+def office_health_monitor(instances):
+    """Verifica periodicamente as instâncias e reinicia uma de cada vez"""
+    while True:
+        time.sleep(app.config['CONVERTER_HEALTH_INTERVAL'])
+        for office in instances:
+            try:
+                busy_since = office.busy_since
+                if busy_since is not None:
+                    # Conversão travada: derruba apenas esta instância, o worker reinicia
+                    if time.monotonic() - busy_since > app.config['CONVERSION_TIMEOUT']:
+                        office.timed_out = True
+                        office.stop()
+                    continue
+                if office.lock.acquire(blocking=False):
+                    try:
+                        if not office.is_healthy():
+                            office.restart()
+                    finally:
+                        office.lock.release()
+            except Exception as e:
+                print(f"Erro ao verificar LibreOffice {office.index}: {str(e)}")
+
+class QueueFullError(Exception):
+    """Fila de conversão cheia; retry_after estima em quantos segundos haverá vaga"""
+
+    def __init__(self, retry_after):
+        super().__init__('Fila de conversão cheia, tente novamente mais tarde')
+        self.retry_after = retry_after
+
+class ConversionScheduler:
+    """Fila de conversão com prioridades, limite de profundidade e divisão justa entre clientes.
+
+    Cada prioridade tem sua própria fila e só é atendida quando as mais urgentes estão
+    vazias. Dentro de uma prioridade os clientes são atendidos em rodízio, de modo que um
+    lote grande de um cliente não atrasa os documentos dos demais.
+    """
+
+    def __init__(self, max_depth, workers):
+        self.max_depth = max_depth
+        self.workers = max(workers, 1)
+        self.lanes = {priority: OrderedDict() for priority in PRIORITIES}  # cliente -> jobs, na ordem do rodízio
+        self.jobs = {}  # conversion_id -> job na fila
+        self.average_duration = 5.0  # Média móvel do tempo de conversão, em segundos
+        self.condition = threading.Condition()
+
+    def full(self):
+        with self.condition:
+            return len(self.jobs) >= self.max_depth
+
+    def put(self, job):
+        """Coloca o job na fila da sua prioridade ou levanta QueueFullError"""
+        with self.condition:
+            if len(self.jobs) >= self.max_depth:
+                raise QueueFullError(self.eta(len(self.jobs)))
+            self.lanes[job['priority']].setdefault(job['client'], deque()).append(job)
+            self.jobs[job['conversion_id']] = job
+            job['enqueued'] = time.perf_counter()
+            set_job_status(job, {
+                'status': 'queued',
+                'message': 'Aguardando conversão'
+            })
+            self.condition.notify()
+
+    def get(self):
+        """Retira o próximo job, aguardando se a fila estiver vazia"""
+        with self.condition:
+            while not self.jobs:
+                self.condition.wait()
+            for lane in self.lanes.values():
+                if lane:
+                    client, jobs = next(iter(lane.items()))
+                    job = jobs.popleft()
+                    # O cliente volta para o fim do rodízio
+                    del lane[client]
+                    if jobs:
+                        lane[client] = jobs
+                    del self.jobs[job['conversion_id']]
+                    return job
+
+    def cancel(self, conversion_id):
+        """Remove o job da fila; retorna o job ou None se ele não está aguardando.
+
+        Os jobs internos, como as partes de um relatório dividido, não são cancelados por aqui.
+        """
+        with self.condition:
+            job = self.jobs.get(conversion_id)
+            if job is None or job.get('internal'):
+                return None
+            del self.jobs[conversion_id]
+            lane = self.lanes[job['priority']]
+            jobs = lane[job['client']]
+            jobs.remove(job)
+            if not jobs:
+                del lane[job['client']]
+            return job
+
+    def position(self, conversion_id):
+        """Quantos jobs serão atendidos antes deste, ou None se ele não está na fila"""
+        with self.condition:
+            job = self.jobs.get(conversion_id)
+            if job is None:
+                return None
+            ahead = 0
+            for priority, lane in self.lanes.items():
+                if priority != job['priority']:
+                    ahead += sum(len(jobs) for jobs in lane.values())
+                    continue
+                # No rodízio, cada cliente é atendido uma vez por rodada
+                clients = list(lane)
+                turn = clients.index(job['client'])
+                rounds = lane[job['client']].index(job)
+                for index, client in enumerate(clients):
+                    queued = len(lane[client])
+                    ahead += min(queued, rounds)
+                    if index < turn and queued > rounds:
+                        ahead += 1
+                return ahead
+
+    def depths(self):
+        """Quantidade de jobs aguardando em cada prioridade"""
+        with self.condition:
+            return {priority: sum(len(jobs) for jobs in lane.values()) for priority, lane in self.lanes.items()}
+
+    def record(self, duration):
+        """Atualiza a média do tempo de conversão usada nas estimativas"""
+        with self.condition:
+            self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+
+    def eta(self, ahead):
+        """Segundos estimados até a conclusão de um job com `ahead` jobs à frente"""
+        return round((ahead // self.workers + 1) * self.average_duration, 1)
+
+app.config['SCHEDULER'] = ConversionScheduler(app.config['CONVERSION_QUEUE_MAX_DEPTH'],
+                                              app.config['CONVERTER_POOL_SIZE'])
+
+def queue_full_response(retry_after):
+    """Resposta 429 com o cabeçalho Retry-After"""
+    response = jsonify({'error': 'Fila de conversão cheia, tente novamente mais tarde', 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, 429
+
+def get_job_priority(filename, default='normal'):
+    """Prioridade da requisição: ?priority= ou a configuração do modelo"""
+    priority = request.args.get('priority') or app.config['MODEL_SETTINGS'].get(filename, {}).get('priority')
+    return priority if priority in PRIORITIES else default
+
+def get_client_id():
+    """Identifica o cliente para a divisão justa da fila"""
+    return request.headers.get('X-Client-Id') or request.remote_addr or 'anonimo'
+
+# Limites dos histogramas de duração (segundos) e de tamanho dos arquivos (bytes)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)
+
+# Descrição e tipo de cada métrica exposta em /metrics
+METRIC_DESCRIPTIONS = {
+    'apipdf_stage_seconds': ('histogram', 'Duração de cada etapa da geração, por modelo'),
+    'apipdf_job_seconds': ('histogram', 'Duração total dos jobs, da criação à conclusão'),
+    'apipdf_output_bytes': ('histogram', 'Tamanho dos arquivos gerados'),
+    'apipdf_conversions_total': ('counter', 'Conversões concluídas por resultado'),
+    'apipdf_worker_busy_seconds_total': ('counter', 'Tempo ocupado de cada worker de conversão'),
+    'apipdf_worker_busy_ratio': ('gauge', 'Fração do tempo em que cada worker esteve ocupado'),
+    'apipdf_queue_depth': ('gauge', 'Jobs aguardando conversão, por prioridade')
+}
+
+class Metrics:
+    """Métricas do processo, expostas no formato de texto do Prometheus"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}  # (nome, rótulos) -> (limites, contagens, soma)
+        self.counters = {}  # (nome, rótulos) -> valor
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = (buckets, [0] * (len(buckets) + 1), [0.0])
+            counts = histogram[1]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            histogram[2][0] += value
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self, gauges):
+        """Texto do Prometheus com os histogramas, contadores e os medidores informados"""
+        samples = {}  # nome -> linhas
+        
+        def line(name, labels, value):
+            text = ','.join(f'{key}="{str(label).replace(chr(34), chr(39))}"' for key, label in labels)
+            return f'{name}{{{text}}} {value}' if text else f'{name} {value}'
+        
+        with self.lock:
+            for (name, labels), (buckets, counts, total) in sorted(self.histograms.items()):
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(line(f'{name}_bucket', labels + (('le', bound),), cumulative))
+                lines.append(line(f'{name}_sum', labels, round(total[0], 6)))
+                lines.append(line(f'{name}_count', labels, cumulative))
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append(line(name, labels, round(value, 6)))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(line(name, tuple(sorted(labels.items())), value))
+        
+        output = []
+        for name, lines in samples.items():
+            metric_type, description = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+    def busy_ratios(self):
+        """Fração do tempo desde o início do processo em que cada worker esteve ocupado"""
+        uptime = max(time.time() - self.started, 1e-9)
+        with self.lock:
+            return [(dict(labels), round(value / uptime, 4)) for (name, labels), value in sorted(self.counters.items())
+                    if name == 'apipdf_worker_busy_seconds_total']
+
+app.config['METRICS'] = Metrics()
+
+@contextmanager
+def stage(job, name):
+    """Mede uma etapa do job, acumulando em job['timings'] e no histograma por modelo"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        job['timings'][name] = round(job['timings'].get(name, 0) + elapsed, 4)
+        if not job.get('internal'):
+            app.config['METRICS'].observe('apipdf_stage_seconds', elapsed, stage=name, model=job['model'])
+
+def record_output(job, path, kind):
+    """Registra o tamanho do arquivo gerado pelo job e, se ele puder ser baixado, o indexa"""
+    if job.get('internal'):
+        return
+    try:
+        if kind == 'xlsx' and not job['keep_excel']:
+            size = os.path.getsize(path)
+        else:
+            size = app.config['ARTIFACTS'].add(path)['size']
+        app.config['METRICS'].observe('apipdf_output_bytes', size, buckets=SIZE_BUCKETS,
+                                      kind=kind, model=job['model'])
+    except OSError:
+        pass
+
+# Worker de conversão em background, um por instância do LibreOffice
+def pdf_conversion_worker(office):
+    app.config['METRICS'].increment('apipdf_worker_busy_seconds_total', 0, worker=office.index)
+    try:
+        office.start()
+    except Exception as e:
+        print(f"Erro ao iniciar LibreOffice {office.index}: {str(e)}")
 
-# Inicia o worker de conversão em background
-def pdf_conversion_worker():
     while True:
         try:
             # Obtém o próximo item da fila
-            excel_path, pdf_path = app.config['CONVERSION_QUEUE'].get()
+            job = app.config['SCHEDULER'].get()
+            started = time.time()
+            excel_paths, pdf_path = job['excel_paths'], job['pdf_path']
+            
+            # Tempo de espera na fila
+            waited = time.perf_counter() - job['enqueued']
+            job['timings']['queue_wait'] = round(waited, 4)
+            if not job.get('internal'):
+                app.config['METRICS'].observe('apipdf_stage_seconds', waited, stage='queue_wait', model=job['model'])
             
             # Atualiza o status
-            conversion_id = os.path.basename(pdf_path)
-            app.config['CONVERSION_STATUS'][conversion_id] = {
+            set_job_status(job, {
                 'status': 'processing',
-                'message': 'Convertendo para PDF...'
-            }
+                'message': 'Convertendo para PDF...',
+                'timings': job['timings']
+            })
             
             try:
-                # Verifica se o arquivo Excel existe e está pronto
-                max_attempts = 5
-                attempt = 0
-                while attempt < max_attempts:
-                    if os.path.exists(excel_path) and os.path.getsize(excel_path) > 0:
-                        break
-                    time.sleep(1)
-                    attempt += 1
+                # Os arquivos são gravados de forma durável antes de entrar na fila
+                if not all(os.path.exists(excel_path) for excel_path in excel_paths):
+                    raise Exception("Arquivo Excel não encontrado para conversão")
                 
-                if attempt >= max_attempts:
-                    raise Exception("Arquivo Excel não está pronto para conversão")
-                
-                # Tenta converter usando LibreOffice
-                if platform.system() == 'Linux':
-                    # Verifica os possíveis caminhos do LibreOffice no Ubuntu
-                    soffice_paths = [
-                        '/usr/bin/soffice',
-                        '/usr/bin/libreoffice',
-                        '/usr/lib/libreoffice/program/soffice',
-                    ]
-                    
-                    soffice = None
-                    for path in soffice_paths:
-                        if os.path.exists(path):
-                            soffice = path
-                            break
-                    
-                    if soffice:
-                        # Mata qualquer processo do LibreOffice que possa estar rodando
-                        try:
-                            subprocess.run(['pkill', 'soffice'], stderr=subprocess.DEVNULL)
-                            time.sleep(1)  # Espera um segundo para garantir que o processo foi finalizado
-                        except:
-                            pass
-                        
-                        # Garante que o diretório de destino existe
-                        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-                        
-                        # Converte para PDF com tempo de espera maior
-                        process = subprocess.run([
-                            soffice,
-                            '--headless',
-                            '--convert-to', 'pdf:writer_pdf_Export',  # Usa o exportador PDF específico
-                            '--outdir', os.path.dirname(pdf_path),
-                            excel_path
-                        ], check=True, timeout=60)  # Aumenta o timeout para 60 segundos
-                        
-                        # Espera um momento para o arquivo ser gerado
-                        time.sleep(2)
-                        
-                        # Renomeia o arquivo
-                        temp_pdf = os.path.join(os.path.dirname(pdf_path), 
-                                              os.path.splitext(os.path.basename(excel_path))[0] + '.pdf')
-                        
-                        # Verifica se o PDF foi gerado e tem conteúdo
-                        if os.path.exists(temp_pdf) and os.path.getsize(temp_pdf) > 0:
-                            shutil.move(temp_pdf, pdf_path)
-                            app.config['CONVERSION_STATUS'][conversion_id] = {
-                                'status': 'completed',
-                                'message': 'Conversão concluída com sucesso',
-                                'pdf_url': f'/download/{os.path.basename(pdf_path)}'
-                            }
+                with office.lock:
+                    try:
+                        if job.get('batch'):
+                            convert_batch(office, job)
                         else:
-                            raise Exception("PDF não foi gerado corretamente")
-                    else:
-                        raise Exception("LibreOffice não encontrado. Instale com: sudo apt-get install libreoffice")
+                            with stage(job, 'convert'):
+                                office.convert(excel_paths[0], pdf_path)
+                    except Exception:
+                        # Reinicia somente a instância que falhou
+                        if not office.is_healthy():
+                            try:
+                                office.restart()
+                            except Exception as e:
+                                print(f"Erro ao reiniciar LibreOffice {office.index}: {str(e)}")
+                        raise
+                
+                # Verifica se o PDF foi gerado e tem conteúdo
+                if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
+                    record_output(job, pdf_path, 'pdf')
+                    set_job_status(job, {
+                        'status': 'completed',
+                        'message': 'Conversão concluída com sucesso',
+                        'pdf_url': f'/download/{os.path.basename(pdf_path)}',
+                        'timings': job['timings']
+                    })
+                    result = 'completed'
                 else:
-                    raise Exception("Sistema operacional não suportado")
+                    raise Exception("PDF não foi gerado corretamente")
+                app.config['SCHEDULER'].record(time.time() - started)
                     
             except subprocess.TimeoutExpired:
-                app.config['CONVERSION_STATUS'][conversion_id] = {
+                set_job_status(job, {
                     'status': 'error',
-                    'message': 'Tempo limite excedido na conversão do PDF'
-                }
+                    'message': 'Tempo limite excedido na conversão do PDF',
+                    'timings': job['timings']
+                })
+                result = 'timeout'
             except Exception as e:
-                app.config['CONVERSION_STATUS'][conversion_id] = {
+                set_job_status(job, {
                     'status': 'error',
-                    'message': f'Erro na conversão: {str(e)}'
-                }
+                    'message': f'Erro na conversão: {str(e)}',
+                    'timings': job['timings']
+                })
+                result = 'error'
+            
+            metrics = app.config['METRICS']
+            if not job.get('internal'):
+                metrics.increment('apipdf_conversions_total', result=result, model=job['model'])
+            metrics.increment('apipdf_worker_busy_seconds_total', time.time() - started, worker=office.index)
             
-            # Remove arquivos temporários após 1 hora
-            threading.Timer(3600, cleanup_temp_files, args=[excel_path, pdf_path]).start()
+            # Avisa quem estiver aguardando o resultado e agenda a limpeza
+            job_finished(job)
             
         except Exception as e:
             print(f"Erro no worker de conversão: {str(e)}")
+
+def create_conversion_job(excel_paths, pdf_path, batch=None, cache_key=None, priority='normal', client=None,
+                          model=None, keep_excel=False, chunk_rows=None, internal=False):
+    """Cria o item da fila de conversão.
+
+    Em lotes, batch indica o formato do resultado: 'zip' com um PDF por documento
+    ou 'pdf' com todos os documentos mesclados. cache_key identifica os jobs cujo
+    PDF fica no cache de resultados; priority e client definem a posição na fila.
+    model identifica o modelo nas métricas. Com keep_excel o XLSX é oferecido para
+    download e segue a limpeza agendada, ou a do cache; sem ele, é removido assim que o
+    job termina.
+    chunk_rows, quando informado, divide tabelas maiores que ele em partes convertidas
+    em paralelo. Jobs internos (internal), como essas partes, não aparecem nos status,
+    nos downloads, nos callbacks nem nas métricas por job; o status fica em job['status'].
+    """
+    if isinstance(excel_paths, str):
+        excel_paths = [excel_paths]
+    return {
+        'conversion_id': os.path.basename(pdf_path),
+        'excel_paths': excel_paths,
+        'pdf_path': pdf_path,
+        'batch': batch,
+        'cache_key': cache_key,
+        'priority': priority,
+        'client': client,
+        'callbacks': [],  # callback_url notificadas ao concluir
+        'model': model,
+        'keep_excel': keep_excel,
+        'chunk_rows': chunk_rows,
+        'internal': internal,
+        'status': None,  # Status dos jobs internos
+        'created': time.perf_counter(),
+        'timings': {},  # Duração de cada etapa, em segundos
+        'done': threading.Event()  # Sinalizado pelo worker ao concluir
+    }
+
+def convert_batch(office, job):
+    """Converte todos os documentos do lote de uma vez e empacota o resultado"""
+    work_dir = os.path.join(app.config['SPOOL_FOLDER'], os.path.splitext(job['conversion_id'])[0])
+    try:
+        with stage(job, 'convert'):
+            pdf_paths = office.convert_many(job['excel_paths'], work_dir)
+        with stage(job, 'package'):
+            package_batch(pdf_paths, job['batch'], job['pdf_path'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def package_batch(pdf_paths, output, result_path):
+    """Junta os PDFs do lote em um ZIP ou em um único PDF mesclado"""
+    for pdf_path in pdf_paths:
+        if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+            raise Exception(f"PDF não foi gerado para {os.path.basename(pdf_path)}")
+    
+    temp_path = unique_temp_path(result_path)
+    if output == 'pdf':
+        writer = PdfWriter()
+        for pdf_path in pdf_paths:
+            writer.append(pdf_path)
+        with open(temp_path, 'wb') as f:
+            writer.write(f)
+    else:
+        # PDFs já são comprimidos, então o ZIP apenas armazena os arquivos
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED) as archive:
+            for index, pdf_path in enumerate(pdf_paths, start=1):
+                archive.write(pdf_path, f'documento_{index:05d}.pdf')
+    os.replace(temp_path, result_path)
+
+def set_first_page_number(excel_path, number):
+    """Troca, direto no XLSX, o número da primeira página das abas com useFirstPageNumber"""
+    temp_path = unique_temp_path(excel_path)
+    with zipfile.ZipFile(excel_path) as source, zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            content = source.read(item)
+            if item.filename.startswith('xl/worksheets/') and b'useFirstPageNumber="1"' in content:
+                content = re.sub(rb'firstPageNumber="\d+"', f'firstPageNumber="{number}"'.encode(), content)
+            target.writestr(item, content)
+    os.replace(temp_path, excel_path)
+
+def run_chunk_jobs(chunk_jobs):
+    """Enfileira as partes, aguarda todas e retorna o número de páginas de cada PDF"""
+    for chunk_job in chunk_jobs:
+        chunk_job['done'].clear()
+        app.config['SCHEDULER'].put(chunk_job)
+    for chunk_job in chunk_jobs:
+        chunk_job['done'].wait()
+        status = chunk_job['status'] or {}
+        if status.get('status') != 'completed':
+            raise Exception(status.get('message', 'Falha na conversão de uma das partes'))
+    return [len(PdfReader(chunk_job['pdf_path']).pages) for chunk_job in chunk_jobs]
+
+def convert_chunks(job, chunk_jobs, numbered):
+    """Converte as partes de um relatório dividido e junta os PDFs no resultado do job.
+
+    Sem número de página no cabeçalho ou rodapé, todas as partes são convertidas em
+    paralelo. Com ele, a primeira parte vai antes: as demais começam a numeração supondo
+    que cada parte tem tantas páginas quanto a primeira, e as partes em que a suposição
+    falhou são convertidas de novo com a numeração real.
+    """
+    try:
+        with stage(job, 'convert'):
+            if not numbered:
+                run_chunk_jobs(chunk_jobs)
+            else:
+                page_counts = run_chunk_jobs(chunk_jobs[:1])
+                estimated = [1] + [page_counts[0] * index + 1 for index in range(1, len(chunk_jobs))]
+                for chunk_job, first_page in zip(chunk_jobs[1:], estimated[1:]):
+                    set_first_page_number(chunk_job['excel_paths'][0], first_page)
+                page_counts += run_chunk_jobs(chunk_jobs[1:])
+                
+                actual = [1]
+                for count in page_counts[:-1]:
+                    actual.append(actual[-1] + count)
+                wrong = [index for index in range(1, len(chunk_jobs)) if actual[index] != estimated[index]]
+                for index in wrong:
+                    set_first_page_number(chunk_jobs[index]['excel_paths'][0], actual[index])
+                run_chunk_jobs([chunk_jobs[index] for index in wrong])
+        with stage(job, 'package'):
+            package_batch([chunk_job['pdf_path'] for chunk_job in chunk_jobs], 'pdf', job['pdf_path'])
+        complete_rendered_job(job)
+    except Exception as e:
+        app.config['CONVERSION_STATUS'][job['conversion_id']] = {
+            'status': 'error',
+            'message': f'Erro na conversão: {str(e)}',
+            'timings': job['timings']
+        }
+        app.config['METRICS'].increment('apipdf_conversions_total', result='error', model=job['model'])
+        job_finished(job)
+    finally:
+        cleanup_temp_files(*[chunk_job['pdf_path'] for chunk_job in chunk_jobs])
+
+def complete_rendered_job(job):
+    """Marca como concluído um job renderizado no próprio processo, sem passar pela fila"""
+    record_output(job, job['pdf_path'], 'pdf')
+    app.config['CONVERSION_STATUS'][job['conversion_id']] = {
+        'status': 'completed',
+        'message': 'Conversão concluída com sucesso',
+        'pdf_url': f"/download/{job['conversion_id']}",
+        'timings': job['timings']
+    }
+    app.config['METRICS'].increment('apipdf_conversions_total', result='completed', model=job['model'])
+    job_finished(job)
+
+def set_job_status(job, status):
+    """Grava o status do job; o de um job interno fica só no próprio job"""
+    if job.get('internal'):
+        job['status'] = status
+    else:
+        app.config['CONVERSION_STATUS'][job['conversion_id']] = status
+
+def job_finished(job):
+    """Libera quem aguarda o job, envia os callbacks e agenda a remoção dos arquivos temporários"""
+    job['done'].set()
+    if job.get('internal'):
+        # Os arquivos das partes são removidos pelo job principal
+        return
+    flush_callbacks(job)
+    app.config['METRICS'].observe('apipdf_job_seconds', time.perf_counter() - job['created'], model=job['model'])
+    
+    # XLSX intermediários saem na hora; PDFs em cache, e o XLSX mantido com eles, são
+    # removidos pela política do próprio cache
+    cleanup_paths = []
+    if not job['keep_excel']:
+        cleanup_temp_files(*job['excel_paths'])
+    if job.get('cache_key'):
+        app.config['RESULT_CACHE'].finish(job)
+    else:
+        if job['keep_excel']:
+            cleanup_paths.extend(job['excel_paths'])
+        cleanup_paths.append(job['pdf_path'])
+    
+    app.config['JANITOR'].schedule(*cleanup_paths)
+
+def resolve_callback_host(hostname):
+    """Resolve o host de um callback e retorna (endereço, None) ou (None, motivo da recusa).
+
+    Com CALLBACK_ALLOWED_HOSTS configurado, só esses hosts são aceitos. Sem a lista, o
+    host precisa resolver apenas para endereços públicos: loopback, redes privadas,
+    link-local (como 169.254.169.254) e afins são recusados. A entrega usa o endereço
+    retornado, sem resolver o host de novo.
+    """
+    allowed = app.config['CALLBACK_ALLOWED_HOSTS']
+    if allowed and hostname not in allowed:
+        return None, f'Host de callback não permitido: {hostname}'
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError):
+        return None, f'Host de callback não encontrado: {hostname}'
+    if not allowed:
+        for address in addresses:
+            if not ipaddress.ip_address(address.split('%')[0]).is_global:
+                return None, f'Host de callback com endereço interno não permitido: {hostname}'
+    return addresses[0], None
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """Conexão HTTP com um endereço já validado; o Host enviado continua sendo o da URL"""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Conexão HTTPS com um endereço já validado; SNI e certificado conferidos com o host da URL"""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+        self.ssl_context = ssl.create_default_context()
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+class CallbackDispatcher:
+    """Entrega as notificações de conclusão enviadas para callback_url.
+
+    Uma única thread faz os POSTs; as entregas que falham são reagendadas com espera
+    exponencial até CALLBACK_MAX_ATTEMPTS tentativas.
+    """
+
+    def __init__(self, max_attempts, timeout):
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.heap = []  # (enviar em, sequência, tentativa, url, payload)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, url, payload, attempt=1, delay=0):
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.sequence, attempt, url, payload))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                _, _, attempt, url, payload = heapq.heappop(self.heap)
+            
+            # O endereço é conferido de novo a cada entrega, pois o DNS pode ter mudado, e a
+            # conexão usa exatamente o endereço conferido
+            parsed = urllib.parse.urlparse(url)
+            address, error = resolve_callback_host(parsed.hostname)
+            if error:
+                print(f"Callback para {url} descartado: {error}")
+                continue
+            try:
+                self._post(parsed, address, payload)
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    self.send(url, payload, attempt + 1, delay=2 ** attempt)
+                else:
+                    print(f"Erro ao enviar callback para {url} após {attempt} tentativas: {str(e)}")
+
+    def _post(self, parsed, address, payload):
+        connection_class = PinnedHTTPSConnection if parsed.scheme == 'https' else PinnedHTTPConnection
+        connection = connection_class(parsed.hostname, address, port=parsed.port, timeout=self.timeout)
+        try:
+            path = parsed.path or '/'
+            if parsed.query:
+                path += f'?{parsed.query}'
+            connection.request('POST', path, body=json.dumps(payload).encode('utf-8'),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            # Redirecionamentos não são seguidos: poderiam levar a um endereço interno
+            if response.status >= 300:
+                raise Exception(f'HTTP {response.status} {response.reason}')
         finally:
-            app.config['CONVERSION_QUEUE'].task_done()
+            connection.close()
+
+app.config['CALLBACKS'] = CallbackDispatcher(app.config['CALLBACK_MAX_ATTEMPTS'], app.config['CALLBACK_TIMEOUT'])
+
+def validate_callback_url(callback_url):
+    """Valida a callback_url do payload; levanta PayloadError se ela não for aceita"""
+    parsed = urllib.parse.urlparse(callback_url) if isinstance(callback_url, str) else None
+    if parsed is None or parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise PayloadError('callback_url deve ser uma URL http ou https')
+    _, error = resolve_callback_host(parsed.hostname)
+    if error:
+        raise PayloadError(error)
+    return callback_url
+
+def add_callback(job, callback_url):
+    """Registra o callback do job; se o job já terminou, ele é enviado imediatamente"""
+    job['callbacks'].append(callback_url)
+    if job['done'].is_set():
+        flush_callbacks(job)
+
+def flush_callbacks(job):
+    """Envia o status final do job para cada callback registrado"""
+    if not job['callbacks']:
+        return
+    status = app.config['CONVERSION_STATUS'].get(job['conversion_id'], {})
+    payload = dict(status, conversion_id=job['conversion_id'])
+    while True:
+        try:
+            callback_url = job['callbacks'].pop()
+        except IndexError:
+            break
+        app.config['CALLBACKS'].send(callback_url, payload)
 
-def cleanup_temp_files(excel_path, pdf_path):
+def unique_temp_path(path):
+    """Arquivo temporário exclusivo na pasta de path, para gravar e depois renomear sobre ele"""
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+
+def save_workbook(wb, path):
+    """Salva o workbook de forma durável: grava em arquivo temporário, sincroniza e renomeia"""
+    temp_path = unique_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        wb.save(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def spool_workbook(wb, path):
+    """Serializa o workbook em memória e o grava de uma vez na pasta de spool, sem sincronizar.
+
+    O arquivo só existe para a conversão e é removido ao fim do job; com SPOOL_FOLDER em
+    tmpfs, o XLSX não chega a tocar o disco.
+    """
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    temp_path = unique_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+    os.replace(temp_path, path)
+
+def cleanup_temp_files(*paths):
     """Remove arquivos temporários após um período"""
     try:
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
     except Exception as e:
         print(f"Erro ao limpar arquivos temporários: {str(e)}")
 
-# Inicia o thread do worker
-conversion_thread = threading.Thread(target=pdf_conversion_worker, daemon=True)
-conversion_thread.start()
+def claim_converter_slot():
+    """Reserva um slot exclusivo deste processo entre os workers da aplicação no host.
 
-@app.route('/conversion-status/<conversion_id>')
-def conversion_status(conversion_id):
-    """Retorna o status atual da conversão"""
+    O slot define as portas UNO e os perfis das instâncias do processo. A reserva é um
+    bloqueio em office_profiles/slot_<n>.lock, liberado pelo sistema quando o processo
+    termina, então os slots de workers encerrados são reaproveitados.
+    """
+    if fcntl is None:
+        return 0
+    folder = app.config['CONVERTER_PROFILE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    for slot in range(app.config['CONVERTER_MAX_SLOTS']):
+        lock_file = open(os.path.join(folder, f'slot_{slot}.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        # O arquivo fica aberto enquanto o processo viver para manter o bloqueio
+        app.config['CONVERTER_SLOT_LOCK'] = lock_file
+        return slot
+    raise Exception(f"Nenhum slot livre para o pool de conversores (limite de {app.config['CONVERTER_MAX_SLOTS']} processos)")
+
+def start_converter_pool():
+    """Inicia um worker por instância do LibreOffice, todos consumindo a mesma fila"""
+    soffice = find_soffice()
+    if soffice and uno is None:
+        message = ("Módulo uno indisponível: cada conversão vai iniciar um soffice em linha de comando, "
+                   "sem instâncias persistentes nem verificação de saúde. Execute a aplicação com um Python "
+                   "que tenha o uno (por exemplo, o pacote python3-uno)")
+        if app.config['CONVERTER_REQUIRE_UNO']:
+            raise RuntimeError(message)
+        print(f"AVISO: {message}")
+    slot = claim_converter_slot()
+    instances = [OfficeInstance(index, soffice, slot) for index in range(app.config['CONVERTER_POOL_SIZE'])]
+    for office in instances:
+        threading.Thread(target=pdf_conversion_worker, args=(office,), daemon=True).start()
+    threading.Thread(target=office_health_monitor, args=(instances,), daemon=True).start()
+    return instances
+
+# Inicia o pool de conversores
+app.config['CONVERTER_POOL'] = start_converter_pool()
+
+# Status a partir dos quais a conversão não muda mais
+FINAL_STATUSES = ('completed', 'error', 'cancelled', 'not_found')
+
+def current_status(conversion_id):
+    """Status atual da conversão; jobs na fila informam a posição e a estimativa de conclusão"""
     status = app.config['CONVERSION_STATUS'].get(conversion_id, {
         'status': 'not_found',
         'message': 'Conversão não encontrada'
     })
-    return jsonify(status)
+    scheduler = app.config['SCHEDULER']
+    ahead = scheduler.position(conversion_id)
+    if ahead is not None:
+        status = dict(status, queue_position=ahead + 1, eta_seconds=scheduler.eta(ahead))
+    return status
+
+@app.route('/conversion-status/<conversion_id>')
+def conversion_status(conversion_id):
+    """Retorna o status atual da conversão"""
+    return jsonify(current_status(conversion_id))
+
+@app.route('/conversion-events')
+@app.route('/conversion-events/<conversion_id>')
+def conversion_events(conversion_id=None):
+    """Fluxo Server-Sent Events com as mudanças de status de uma ou mais conversões (?ids=a,b)"""
+    conversion_ids = [conversion_id] if conversion_id else [
+        item for item in request.args.get('ids', '').split(',') if item]
+    if not conversion_ids:
+        return jsonify({'error': 'Informe a conversão no caminho ou em ?ids='}), 400
+    if len(conversion_ids) > app.config['SSE_MAX_IDS']:
+        return jsonify({'error': f'Acompanhe no máximo {app.config["SSE_MAX_IDS"]} conversões por fluxo'}), 400
+    
+    statuses = app.config['CONVERSION_STATUS']
+    # Assina antes de ler o status atual para não perder mudanças
+    events = statuses.subscribe(conversion_ids)
+    
+    def stream():
+        sent = {}
+        pending = set(conversion_ids)
+        
+        def emit(conversion_id, status):
+            sent[conversion_id] = status
+            if status.get('status') in FINAL_STATUSES:
+                pending.discard(conversion_id)
+            return f"event: status\ndata: {json.dumps(dict(status, conversion_id=conversion_id))}\n\n"
+        
+        try:
+            for conversion_id in conversion_ids:
+                yield emit(conversion_id, current_status(conversion_id))
+            while pending:
+                try:
+                    conversion_id, status = events.get(timeout=app.config['SSE_HEARTBEAT'])
+                except Empty:
+                    # Mudanças feitas por outros processos chegam pelo armazenamento compartilhado
+                    yield ': keep-alive\n\n'
+                    for conversion_id in list(pending):
+                        status = current_status(conversion_id)
+                        if status != sent.get(conversion_id):
+                            yield emit(conversion_id, status)
+                    continue
+                if conversion_id in pending:
+                    yield emit(conversion_id, status)
+        finally:
+            statuses.unsubscribe(conversion_ids, events)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics():
+    """Métricas do processo no formato de texto do Prometheus"""
+    gauges = [('apipdf_queue_depth', {'priority': priority}, depth)
+              for priority, depth in app.config['SCHEDULER'].depths().items()]
+    gauges += [('apipdf_worker_busy_ratio', labels, ratio) for labels, ratio in app.config['METRICS'].busy_ratios()]
+    return Response(app.config['METRICS'].render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/conversion-status/<conversion_id>', methods=['DELETE'])
+def cancel_conversion(conversion_id):
+    """Cancela uma conversão que ainda está aguardando na fila"""
+    job = app.config['SCHEDULER'].cancel(conversion_id)
+    if job is None:
+        if app.config['CONVERSION_STATUS'].get(conversion_id) is None:
+            return jsonify({'error': 'Conversão não encontrada'}), 404
+        return jsonify({'error': 'A conversão não está na fila e não pode ser cancelada'}), 409
+    
+    app.config['CONVERSION_STATUS'][conversion_id] = {
+        'status': 'cancelled',
+        'message': 'Conversão cancelada'
+    }
+    job_finished(job)
+    return jsonify({'message': 'Conversão cancelada'}), 200
+
+def catalog_page(default_per_page):
+    """Filtra e pagina o catálogo conforme ?q=, ?engine=, ?page= e ?per_page="""
+    entries, listing_etag = app.config['MODEL_CATALOG'].list()
+    
+    query = request.args.get('q', '').strip().lower()
+    if query:
+        entries = [entry for entry in entries if query in entry['name'].lower()]
+    engine = request.args.get('engine')
+    if engine:
+        entries = [entry for entry in entries if entry['engine'] == engine]
+    
+    per_page = min(max(request.args.get('per_page', default_per_page, type=int), 1), app.config['MODELS_MAX_PER_PAGE'])
+    pages = max(math.ceil(len(entries) / per_page), 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    return {
+        'models': entries[(page - 1) * per_page:page * per_page],
+        'page': page,
+        'per_page': per_page,
+        'pages': pages,
+        'total': len(entries)
+    }, listing_etag
+
+def catalog_model(entry, include=('schema', 'example_payload')):
+    """Entrada do catálogo com a URL de geração, limitada aos campos pedidos"""
+    model = {key: value for key, value in entry.items() if key not in ('schema', 'example_payload') or key in include}
+    model['endpoint'] = url_for('generate_from_model', model_name=entry['model'], _external=True)
+    return model
 
 @app.route('/')
 def index():
-    # Lista todos os arquivos XLSX na pasta de uploads
-    files = []
-    if os.path.exists(app.config['UPLOAD_FOLDER']):
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            if filename.endswith('.xlsx'):
-                model_info = app.config['MODEL_INFO'].get(filename, {})
-                
-                # Cria um exemplo de payload baseado nas informações do modelo
-                example_payload = {}
-                
-                # Adiciona exemplos para variáveis simples
-                for var in model_info.get('variables', []):
-                    if var['type'] == 'text':
-                        example_payload[var['name']] = f"Exemplo {var['name']}"
-                    elif var['type'] == 'int':
-                        example_payload[var['name']] = 123
-                    elif var['type'] == 'double':
-                        example_payload[var['name']] = 123.45
-                    elif var['type'] == 'date':
-                        example_payload[var['name']] = "11-03-2024"
-                
-                # Organiza campos por tabela
-                tables = {}
-                for table in model_info.get('tables', []):
-                    table_name = table['name']
-                    if table_name not in tables:
-                        tables[table_name] = []
-                    tables[table_name].append(table)
-                
-                # Adiciona exemplos para tabelas
-                for table_name, fields in tables.items():
-                    example_row = {}
-                    for field in fields:
-                        if field['type'] == 'text':
-                            example_row[field['field']] = f"Exemplo {field['field']}"
-                        elif field['type'] == 'int':
-                            example_row[field['field']] = 123
-                        elif field['type'] == 'double':
-                            example_row[field['field']] = 123.45
-                        elif field['type'] == 'date':
-                            example_row[field['field']] = "11-03-2024"
-                    
-                    # Adiciona dois exemplos de linha para cada tabela
-                    example_payload[table_name] = [
-                        example_row,
-                        {k: v for k, v in example_row.items()}  # Uma cópia do primeiro exemplo
-                    ]
-                
-                file_info = {
-                    'name': filename,
-                    'endpoint': url_for('generate_from_model', model_name=filename[:-5], _external=True),
-                    'schema': model_info,  # Mantém o schema original
-                    'example_payload': example_payload  # Adiciona o exemplo de payload
-                }
-                files.append(file_info)
-    return render_template('index.html', files=files)
+    # Mostra só uma página do catálogo em cache; ?q= filtra pelo nome
+    result, _ = catalog_page(app.config['INDEX_PAGE_SIZE'])
+    files = [catalog_model(entry) for entry in result['models']]
+    return render_template('index.html', files=files, page=result['page'], pages=result['pages'],
+                           total=result['total'], query=request.args.get('q', ''))
+
+@app.route('/api/models')
+def list_models():
+    """Catálogo paginado dos modelos.
+
+    Filtros: ?q= (parte do nome) e ?engine=; paginação: ?page= e ?per_page=.
+    ?include=schema,example_payload acrescenta esses campos a cada modelo. O ETag
+    muda com as versões dos modelos e com a consulta; If-None-Match devolve 304.
+    """
+    include = [field for field in request.args.get('include', '').split(',') if field]
+    result, listing_etag = catalog_page(app.config['MODELS_PER_PAGE'])
+    etag = hashlib.sha256(f'{listing_etag}|{request.query_string.decode()}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        result['models'] = [catalog_model(entry, include) for entry in result['models']]
+        response = jsonify(result)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -319,75 +2930,33 @@ def upload_file():
         # Garante que a pasta uploads existe
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         
-        # Salva o arquivo
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(filepath)
+        # Salva o envio como uma nova versão imutável; a versão publicada não é tocada
+        version_path, version = store_template_version(file.stream)
         
-        # Analisa o arquivo XLSX para extrair informações
-        wb = load_workbook(filepath)
-        sheet = wb.active
+        # Analisa o arquivo XLSX e compila o plano de renderização
+        try:
+            model_info, plan = analyze_template(version_path)
+        except Exception as e:
+            # O modelo inválido não substitui a versão em uso
+            if not any(current['version'] == version for current in list(app.config['RENDER_PLANS'].values())):
+                cleanup_temp_files(version_path)
+            if isinstance(e, TemplateError):
+                return f'Erro no modelo: {str(e)}', 400
+            raise
         
-        # Inicializa as informações do modelo
-        model_info = {
-            'variables': [],
-            'tables': []
-        }
+        # Motor de renderização opcional escolhido no envio
+        engine = request.form.get('engine')
+        if engine in RENDER_ENGINES:
+            app.config['MODEL_SETTINGS'].setdefault(file.filename, {})['engine'] = engine
+            save_model_settings()
         
-        # Procura por células com marcadores especiais
-        for row in sheet.iter_rows():
-            for cell in row:
-                if cell.value and isinstance(cell.value, str):
-                    # Procura por variáveis (formato: ${nome:tipo})
-                    var_matches = re.finditer(r'\${([^:]+):([^}]+)}', cell.value)
-                    for match in var_matches:
-                        name, type_info = match.groups()
-                        model_info['variables'].append({
-                            'name': name,
-                            'type': type_info,
-                            'cell': cell.coordinate
-                        })
-                    
-                    # Procura por tabelas (formato: #{tabela.campo:tipo})
-                    table_matches = re.finditer(r'#{([^.]+)\.([^:]+):([^}]+)}', cell.value)
-                    for match in table_matches:
-                        table_name, field, type_info = match.groups()
-                        model_info['tables'].append({
-                            'name': table_name,
-                            'field': field,
-                            'type': type_info,
-                            'start_cell': cell.coordinate
-                        })
-                    
-                    # Procura por cálculos (formato: %{tabela.campo:operação})
-                    calc_matches = re.finditer(r'%{([^}]+)}', cell.value)
-                    for match in calc_matches:
-                        calc_expression = match.group(1)
-                        # Divide a expressão em tabela.campo:operação
-                        parts = calc_expression.split(':')
-                        if len(parts) != 2:
-                            continue
-                        
-                        field_parts = parts[0].split('.')
-                        if len(field_parts) != 2:
-                            continue
-                        
-                        table_name = field_parts[0]
-                        field_name = field_parts[1]
-                        operation = parts[1]
-                        
-                        model_info['calculations'] = model_info.get('calculations', [])
-                        model_info['calculations'].append({
-                            'table_name': table_name,
-                            'field_name': field_name,
-                            'operation': operation,
-                            'cell': cell.coordinate
-                        })
-        
-        # Armazena as informações do modelo
-        app.config['MODEL_INFO'][file.filename] = model_info
-        
-        # Fecha o workbook
-        wb.close()
+        # Publica o arquivo em uploads/ e só então troca a versão do modelo; as requisições
+        # em andamento seguem com a versão anterior, que fica no cache até sair pelo LRU
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
+        with app.config['MODEL_LOCK']:
+            publish_template(version_path, filepath)
+            register_model(file.filename, model_info, plan)
+        prune_template_versions()
         
         return 'Arquivo enviado com sucesso', 200
     
@@ -396,29 +2965,800 @@ def upload_file():
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
-    # Verifica em todas as pastas possíveis
-    for folder in [app.config['DOWNLOAD_FOLDER'], app.config['TEMP_FOLDER'], app.config['UPLOAD_FOLDER']]:
-        if os.path.exists(os.path.join(folder, filename)):
-            return send_from_directory(folder, filename)
-    return "Arquivo não encontrado", 404
+    entry = app.config['ARTIFACTS'].lookup(filename)
+    if not entry:
+        return "Arquivo não encontrado", 404
+    return send_artifact(entry)
+
+def send_artifact(entry, mimetype=None, download_name=None):
+    """Envia um arquivo do índice com ETag do conteúdo, respostas 304 e requisições Range.
+
+    Com DOWNLOAD_ACCEL, a resposta leva apenas os cabeçalhos e o proxy reverso envia os
+    bytes: X-Accel-Redirect aponta para DOWNLOAD_ACCEL_PREFIX seguido do caminho relativo
+    à aplicação, e X-Sendfile para o caminho absoluto.
+    """
+    accel = app.config['DOWNLOAD_ACCEL']
+    if not accel:
+        return send_file(os.path.abspath(entry['path']), mimetype=mimetype, as_attachment=bool(download_name),
+                         download_name=download_name, conditional=True, etag=entry['hash'])
+    
+    response = Response(mimetype=mimetype or mimetypes.guess_type(entry['path'])[0] or 'application/octet-stream')
+    response.set_etag(entry['hash'])
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    if download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    if accel == 'x-accel-redirect':
+        relative_path = os.path.relpath(entry['path']).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/')}/{relative_path}"
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(entry['path'])
+    return response
 
 @app.route('/delete/<filename>', methods=['POST'])
 def delete_model(filename):
     try:
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         if os.path.exists(file_path):
-            os.remove(file_path)
-            if filename in app.config['MODEL_INFO']:
-                del app.config['MODEL_INFO'][filename]
+            # As requisições em andamento ainda usam a versão imutável até o fim do prazo
+            with app.config['MODEL_LOCK']:
+                os.remove(file_path)
+                unregister_model(filename)
+            app.config['TEMPLATE_CACHE'].invalidate(filename)
+            if app.config['MODEL_SETTINGS'].pop(filename, None) is not None:
+                save_model_settings()
             return jsonify({'message': 'Modelo excluído com sucesso'}), 200
         return jsonify({'error': 'Arquivo não encontrado'}), 404
     except Exception as e:
         return jsonify({'error': f'Erro ao excluir arquivo: {str(e)}'}), 500
 
+@app.route('/settings/<filename>', methods=['POST'])
+def update_model_settings(filename):
+    """Atualiza as configurações de um modelo: motor de renderização e prioridade na fila"""
+    if not ensure_model(filename):
+        return jsonify({'error': 'Modelo não encontrado'}), 404
+    
+    data = request.get_json() or {}
+    if 'engine' not in data and 'priority' not in data:
+        return jsonify({'error': 'Informe "engine" e/ou "priority"'}), 400
+    if 'engine' in data and data['engine'] not in RENDER_ENGINES:
+        return jsonify({'error': f'Motor de renderização inválido. Use: {", ".join(RENDER_ENGINES)}'}), 400
+    if 'priority' in data and data['priority'] not in PRIORITIES:
+        return jsonify({'error': f'Prioridade inválida. Use: {", ".join(PRIORITIES)}'}), 400
+    
+    try:
+        settings = app.config['MODEL_SETTINGS'].setdefault(filename, {})
+        for key in ('engine', 'priority'):
+            if key in data:
+                settings[key] = data[key]
+        save_model_settings()
+        app.config['MODEL_CATALOG'].invalidate(filename)
+        return jsonify({'message': 'Configurações atualizadas', 'settings': app.config['MODEL_SETTINGS'][filename]}), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao salvar configurações: {str(e)}'}), 500
+
+# Estilos de borda do Excel convertidos para CSS
+BORDER_STYLES = {
+    'hair': '0.5pt solid',
+    'thin': '1px solid',
+    'dotted': '1px dotted',
+    'dashed': '1px dashed',
+    'dashDot': '1px dashed',
+    'dashDotDot': '1px dashed',
+    'medium': '2px solid',
+    'mediumDashed': '2px dashed',
+    'mediumDashDot': '2px dashed',
+    'mediumDashDotDot': '2px dashed',
+    'slantDashDot': '2px dashed',
+    'thick': '3px solid',
+    'double': '3px double',
+}
+
+SHEET_HTML_TEMPLATE = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        @page { size: {{ page_size }}; margin: {{ margins }}; }
+        body { margin: 0; font-family: Calibri, Arial, sans-serif; font-size: 11pt; }
+        table { border-collapse: collapse; table-layout: fixed; }
+        td { padding: 0 2pt; overflow: hidden; vertical-align: bottom; white-space: nowrap; }
+    </style>
+</head>
+<body>
+    <table style="width: {{ table_width }}pt">
+        <colgroup>{% for width in column_widths %}<col style="width: {{ width }}pt">{% endfor %}</colgroup>
+        {% for row in rows %}<tr style="height: {{ row.height }}pt">{% for cell in row.cells %}<td{% if cell.rowspan > 1 %} rowspan="{{ cell.rowspan }}"{% endif %}{% if cell.colspan > 1 %} colspan="{{ cell.colspan }}"{% endif %} style="{{ cell.style }}">{{ cell.text }}</td>{% endfor %}</tr>
+        {% endfor %}
+    </table>
+</body>
+</html>""", autoescape=True)
+
+def css_color(color):
+    """Converte uma cor do openpyxl (ARGB) para CSS; cores de tema são ignoradas"""
+    if color is None or color.type != 'rgb' or not isinstance(color.rgb, str):
+        return None
+    return f'#{color.rgb[-6:]}'
+
+def cell_css(cell):
+    """Monta o CSS da célula a partir da fonte, preenchimento, bordas e alinhamento"""
+    styles = []
+    
+    font = cell.font
+    if font.b:
+        styles.append('font-weight: bold')
+    if font.i:
+        styles.append('font-style: italic')
+    if font.u:
+        styles.append('text-decoration: underline')
+    if font.sz:
+        styles.append(f'font-size: {font.sz}pt')
+    if font.name:
+        styles.append(f"font-family: '{font.name.replace(chr(39), '')}', sans-serif")
+    color = css_color(font.color)
+    if color:
+        styles.append(f'color: {color}')
+    
+    if cell.fill.fill_type == 'solid':
+        background = css_color(cell.fill.fgColor)
+        if background:
+            styles.append(f'background-color: {background}')
+    
+    for side_name in ('top', 'right', 'bottom', 'left'):
+        side = getattr(cell.border, side_name)
+        if side is not None and side.style:
+            border = BORDER_STYLES.get(side.style, '1px solid')
+            styles.append(f'border-{side_name}: {border} {css_color(side.color) or "#000000"}')
+    
+    alignment = cell.alignment
+    if alignment.horizontal in ('left', 'center', 'right', 'justify'):
+        styles.append(f'text-align: {alignment.horizontal}')
+    elif alignment.horizontal == 'centerContinuous':
+        styles.append('text-align: center')
+    if alignment.vertical in ('top', 'bottom'):
+        styles.append(f'vertical-align: {alignment.vertical}')
+    elif alignment.vertical == 'center':
+        styles.append('vertical-align: middle')
+    if alignment.wrap_text:
+        styles.append('white-space: pre-wrap')
+    
+    return '; '.join(styles)
+
+def excel_date_pattern(number_format):
+    """Traduz um formato de data do Excel para o padrão do strftime"""
+    section = number_format.split(';')[0].lower()
+    section = re.sub(r'\[[^\]]*\]|"[^"]*"|\\', '', section)
+    if not any(token in section for token in ('d', 'y', 'h')):
+        return '%d/%m/%Y'
+    
+    pattern = []
+    last_token = None
+    for token in re.findall(r'yyyy|yy|dd|d|mm|m|hh|h|ss|s|am/pm|.', section):
+        if token in ('yyyy', 'yy'):
+            pattern.append('%Y' if token == 'yyyy' else '%y')
+        elif token in ('dd', 'd'):
+            pattern.append('%d')
+        elif token in ('mm', 'm'):
+            # Depois de horas, "mm" representa minutos
+            pattern.append('%M' if last_token in ('hh', 'h') else '%m')
+        elif token in ('hh', 'h'):
+            pattern.append('%I' if 'am/pm' in section else '%H')
+        elif token in ('ss', 's'):
+            pattern.append('%S')
+        elif token == 'am/pm':
+            pattern.append('%p')
+        else:
+            pattern.append(token.replace('%', '%%'))
+            continue
+        last_token = token
+    return ''.join(pattern)
+
+def format_number(value, number_format):
+    """Formata um número conforme o formato do Excel, no padrão brasileiro"""
+    section = (number_format or 'General').split(';')[0]
+    if section == 'General':
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value).replace('.', ',')
+    
+    # Textos fixos, como "R$ " ou [$R$-416]
+    prefix = ''.join(re.findall(r'\[\$([^\]-]*)', section))
+    prefix += ''.join(re.findall(r'"([^"]*)"', section.split('0')[0].split('#')[0]))
+    
+    if '%' in section:
+        value = value * 100
+    decimals_match = re.search(r'0[.,](0+)', section)
+    decimals = len(decimals_match.group(1)) if decimals_match else 0
+    
+    if '#,##' in section or '#.##' in section:
+        text = f'{value:,.{decimals}f}'.replace(',', '_').replace('.', ',').replace('_', '.')
+    else:
+        text = f'{value:.{decimals}f}'.replace('.', ',')
+    return prefix + text + ('%' if '%' in section else '')
+
+def format_cell_value(cell):
+    """Retorna o texto exibido pela célula, aplicando o formato numérico"""
+    value = cell.value
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.strftime(excel_date_pattern(cell.number_format or ''))
+    if isinstance(value, bool):
+        return 'VERDADEIRO' if value else 'FALSO'
+    if isinstance(value, (int, float)):
+        return format_number(value, cell.number_format)
+    return str(value)
+
+def sheet_to_html(sheet):
+    """Converte a planilha preenchida em HTML/CSS para renderização com o WeasyPrint"""
+    max_row = sheet.max_row
+    max_col = sheet.max_column
+    
+    # Larguras de coluna (em caracteres no Excel) convertidas para pontos
+    default_width = sheet.sheet_format.defaultColWidth or 8.43
+    widths = {}
+    hidden_columns = set()
+    for key, dimension in sheet.column_dimensions.items():
+        first = dimension.min or column_index_from_string(key)
+        last = dimension.max or first
+        for index in range(first, last + 1):
+            if dimension.hidden:
+                hidden_columns.add(index)
+            if dimension.width:
+                widths[index] = dimension.width
+    columns = [index for index in range(1, max_col + 1) if index not in hidden_columns]
+    column_widths = [round((widths.get(index, default_width) * 7 + 5) * 0.75, 2) for index in columns]
+    
+    # Células mescladas: a primeira recebe rowspan/colspan e as demais são omitidas
+    spans = {}
+    covered = set()
+    for merged in sheet.merged_cells.ranges:
+        spans[(merged.min_row, merged.min_col)] = (
+            merged.max_row - merged.min_row + 1,
+            len([index for index in range(merged.min_col, merged.max_col + 1) if index not in hidden_columns])
+        )
+        for row in range(merged.min_row, merged.max_row + 1):
+            for col in range(merged.min_col, merged.max_col + 1):
+                if (row, col) != (merged.min_row, merged.min_col):
+                    covered.add((row, col))
+    
+    default_height = sheet.sheet_format.defaultRowHeight or 15
+    style_cache = {}
+    rows = []
+    for row_index in range(1, max_row + 1):
+        dimension = sheet.row_dimensions.get(row_index)
+        if dimension is not None and dimension.hidden:
+            continue
+        cells = []
+        for col_index in columns:
+            if (row_index, col_index) in covered:
+                continue
+            cell = sheet.cell(row=row_index, column=col_index)
+            if cell.style_id not in style_cache:
+                style_cache[cell.style_id] = cell_css(cell)
+            style = style_cache[cell.style_id]
+            # Alinhamento geral do Excel: números à direita
+            if cell.alignment.horizontal in (None, 'general') and isinstance(cell.value, (int, float, datetime, date)):
+                style = f'{style}; text-align: right' if style else 'text-align: right'
+            rowspan, colspan = spans.get((row_index, col_index), (1, 1))
+            cells.append({
+                'text': format_cell_value(cell),
+                'style': style,
+                'rowspan': rowspan,
+                'colspan': colspan
+            })
+        height = dimension.height if dimension is not None and dimension.height else default_height
+        rows.append({'height': height, 'cells': cells})
+    
+    page_setup = sheet.page_setup
+    page_size = 'letter' if str(page_setup.paperSize) == '1' else 'A4'
+    if page_setup.orientation == 'landscape':
+        page_size += ' landscape'
+    margins = sheet.page_margins
+    
+    return SHEET_HTML_TEMPLATE.render(
+        page_size=page_size,
+        margins=f'{margins.top}in {margins.right}in {margins.bottom}in {margins.left}in',
+        table_width=sum(column_widths),
+        column_widths=column_widths,
+        rows=rows
+    )
+
+def render_pdf_weasyprint(wb, pdf_path):
+    """Renderiza o workbook preenchido diretamente em PDF, sem o LibreOffice.
+
+    Cada aba visível vira uma seção do PDF, começando em nova página e com o próprio
+    tamanho e orientação de página.
+    """
+    sheets = [sheet for sheet in wb.worksheets if sheet.sheet_state == 'visible'] or [wb.active]
+    documents = [HTML(string=sheet_to_html(sheet)).render() for sheet in sheets]
+    pages = [page for document in documents for page in document.pages]
+    temp_path = unique_temp_path(pdf_path)
+    documents[0].copy(pages).write_pdf(temp_path)
+    os.replace(temp_path, pdf_path)
+
+def get_model_engine(filename):
+    """Motor de renderização da requisição: ?engine= ou a configuração do modelo"""
+    engine = request.args.get('engine') or app.config['MODEL_SETTINGS'].get(filename, {}).get('engine')
+    return engine if engine in RENDER_ENGINES else 'libreoffice'
+
+def generate_error_pdf(error_message):
+    """Gera um PDF de erro a partir do template de erro e retorna o nome do arquivo"""
+    try:
+        html = render_template('error_template.html', error_message=error_message,
+                               timestamp=datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        pdf_filename = f'error_{timestamp}_{uuid.uuid4().hex[:8]}.pdf'
+        os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
+        HTML(string=html).write_pdf(os.path.join(app.config['DOWNLOAD_FOLDER'], pdf_filename))
+        return pdf_filename
+    except Exception as e:
+        print(f"Erro ao gerar PDF de erro: {str(e)}")
+        return None
+
+# Formato numérico aplicado aos campos de tabela de cada tipo
+TYPE_NUMBER_FORMATS = {
+    'double': '#.##0,00',
+    'int': '#.##0',
+    'date': 'dd/mm/yyyy'
+}
+
+def number_format_id(wb, number_format):
+    """Registra o formato numérico no workbook e retorna seu identificador"""
+    if number_format in BUILTIN_FORMATS_REVERSE:
+        return BUILTIN_FORMATS_REVERSE[number_format]
+    return wb._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+
+def expand_rows(sheet, after_row, count):
+    """Abre count linhas logo abaixo de after_row em uma única passagem.
+
+    Diferente do insert_rows do openpyxl, também desloca as células mescladas e as
+    alturas das linhas abaixo, e estende as mesclagens que cruzam a linha modelo.
+    """
+    shifted_cells = {}
+    for (row, col), cell in sheet._cells.items():
+        if row > after_row:
+            row += count
+            cell.row = row
+        shifted_cells[(row, col)] = cell
+    sheet._cells = shifted_cells
+    
+    for merged in sheet.merged_cells.ranges:
+        if merged.min_row > after_row:
+            merged.shift(row_shift=count)
+        elif merged.max_row > after_row:
+            merged.expand(down=count)
+    
+    dimensions = [(index, dimension) for index, dimension in sheet.row_dimensions.items() if index > after_row]
+    for index, _ in dimensions:
+        del sheet.row_dimensions[index]
+    for index, dimension in dimensions:
+        dimension.index = index + count
+        sheet.row_dimensions[index + count] = dimension
+
+class PayloadError(Exception):
+    """Erro nos dados enviados para preencher o modelo; errors lista todos os problemas encontrados"""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or [message]
+
+def payload_error(errors):
+    """PayloadError com todos os problemas do payload, limitados a PAYLOAD_MAX_ERRORS na resposta"""
+    message = errors[0] if len(errors) == 1 else f'{len(errors)} erros no payload'
+    return PayloadError(message, errors[:app.config['PAYLOAD_MAX_ERRORS']])
+
+def payload_error_response(error):
+    return jsonify({'error': str(error), 'errors': error.errors}), 400
+
+# Formatos aceitos para os campos do tipo date, na ordem em que são tentados
+DATE_FORMATS = ('%d-%m-%Y', '%Y-%m-%d')
+
+def coerce_value(value, field_type):
+    """Converte um valor para o tipo do marcador; levanta ValueError ou TypeError se não for possível"""
+    if field_type == 'date':
+        if isinstance(value, str):
+            for date_format in DATE_FORMATS:
+                try:
+                    return datetime.strptime(value, date_format)
+                except ValueError:
+                    pass
+        raise ValueError(value)
+    if field_type == 'int':
+        return int(value)
+    if field_type == 'double':
+        return float(value)
+    return value
+
+def coerce_column(values, field_type):
+    """Converte uma coluna da tabela e retorna os valores convertidos e os índices inválidos.
+
+    As datas são interpretadas de uma vez pelo pandas; apenas as que ele não reconhece
+    passam pela conversão individual, que tem a mesma regra do strptime.
+    """
+    if field_type not in ('date', 'int', 'double'):
+        return values, []
+    
+    converted = list(values)
+    if field_type == 'date':
+        series = pd.Series(values, dtype=object)
+        text = series.where(series.map(lambda value: isinstance(value, str)))
+        parsed = pd.to_datetime(text, format=DATE_FORMATS[0], errors='coerce')
+        for date_format in DATE_FORMATS[1:]:
+            missing = parsed.isna() & text.notna()
+            if not missing.any():
+                break
+            parsed[missing] = pd.to_datetime(text[missing], format=date_format, errors='coerce')
+        converted = [None if pd.isna(value) else value for value in parsed.dt.to_pydatetime()]
+    
+    invalid = []
+    for index, value in enumerate(values):
+        if value is None or (field_type == 'date' and converted[index] is not None):
+            continue
+        try:
+            converted[index] = coerce_value(value, field_type)
+        except (TypeError, ValueError, OverflowError):
+            invalid.append(index)
+    return converted, invalid
+
+def type_error_message(field_type, name):
+    if field_type == 'date':
+        return f'Formato de data inválido para {name}. Use DD-MM-YYYY'
+    if field_type == 'int':
+        return f'Valor inteiro inválido para {name}'
+    return f'Valor numérico inválido para {name}'
+
+def coerce_rows(rows, fields, table_name, first_line=1):
+    """Converte as linhas de uma tabela coluna a coluna; retorna as linhas convertidas e os erros.
+
+    first_line é o número da primeira linha, usado nas mensagens quando as linhas chegam em blocos.
+    """
+    # As linhas que não são objetos entram nos erros, mas as demais continuam sendo conferidas
+    errors = [f'Linha {index} da tabela {table_name} deve ser um objeto'
+              for index, row in enumerate(rows, start=first_line) if not isinstance(row, dict)]
+    columns = {}
+    for field, field_type in fields.items():
+        if field_type not in ('date', 'int', 'double'):
+            continue
+        converted, invalid = coerce_column([row.get(field) if isinstance(row, dict) else None for row in rows],
+                                           field_type)
+        errors.extend(type_error_message(field_type, f'{field} em {table_name}, linha {index + first_line}')
+                      for index in invalid)
+        columns[field] = converted
+    if not columns:
+        return rows, errors
+    
+    # Só então monta as linhas convertidas
+    converted_rows = [dict(row) if isinstance(row, dict) else row for row in rows]
+    for field, converted in columns.items():
+        for row, value in zip(converted_rows, converted):
+            if isinstance(row, dict) and field in row:
+                row[field] = value
+    return converted_rows, errors
+
+def validate_payload(validator, data):
+    """Valida e converte o payload inteiro antes de qualquer acesso ao modelo.
+
+    Retorna uma cópia do payload com os valores já nos tipos dos marcadores; se algum
+    valor for inválido, levanta PayloadError com todos os erros de uma vez. Tabelas
+    recebidas como TableStream são validadas em uma leitura do arquivo, bloco a bloco.
+    """
+    if not isinstance(data, dict):
+        raise PayloadError('O payload deve ser um objeto JSON')
+    
+    errors = []
+    values = dict(data)
+    for name, field_type in validator['variables'].items():
+        if data.get(name) is None:
+            continue
+        try:
+            values[name] = coerce_value(data[name], field_type)
+        except (TypeError, ValueError, OverflowError):
+            errors.append(type_error_message(field_type, name))
+    
+    for table_name, fields in validator['tables'].items():
+        if table_name not in data:
+            continue
+        rows = data[table_name]
+        if isinstance(rows, TableStream):
+            errors.extend(rows.validate(fields, table_name, validator['aggregate_columns'].get(table_name, [])))
+        elif isinstance(rows, list):
+            values[table_name], table_errors = coerce_rows(rows, fields, table_name)
+            errors.extend(table_errors)
+        else:
+            errors.append(f'Dados da tabela {table_name} devem ser uma lista')
+    
+    if errors:
+        raise payload_error(errors)
+    return values
+
+# Formatos aceitos para as tabelas enviadas em partes de uma requisição multipart
+STREAM_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv'
+}
+STREAM_EXTENSIONS = {
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.csv': 'csv'
+}
+
+def ndjson_rows(lines):
+    """Uma linha do payload por linha do arquivo; linhas que não são JSON viram None e são rejeitadas na validação"""
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+def csv_rows(lines):
+    """Linhas do CSV com cabeçalho; campos vazios valem como ausentes"""
+    for row in csv.DictReader(lines):
+        yield {field: value for field, value in row.items() if field is not None and value != ''}
+
+class TableStream:
+    """Linhas de uma tabela recebidas em NDJSON ou CSV e lidas do disco em blocos.
+
+    O arquivo é lido uma vez na validação, que também guarda as colunas usadas nos
+    agregados, e outra no preenchimento, de modo que as linhas nunca ficam todas na
+    memória. Depois de validate, a iteração devolve as linhas já convertidas para os
+    tipos dos campos.
+    """
+
+    def __init__(self, path, file_format, digest):
+        self.path = path
+        self.file_format = file_format
+        self.digest = digest  # Hash do conteúdo, usado na chave do cache
+        self.fields = {}
+        self.count = 0
+        self.frame = None  # Colunas dos agregados, já convertidas
+
+    def __len__(self):
+        return self.count
+
+    def raw_chunks(self):
+        """Blocos de até STREAM_CHUNK_ROWS linhas, como foram enviadas"""
+        with open(self.path, encoding='utf-8-sig', newline='') as f:
+            rows = csv_rows(f) if self.file_format == 'csv' else ndjson_rows(f)
+            while True:
+                chunk = list(islice(rows, app.config['STREAM_CHUNK_ROWS']))
+                if not chunk:
+                    return
+                yield chunk
+
+    def validate(self, fields, table_name, columns=()):
+        """Valida todas as linhas, conta-as e retorna os erros encontrados.
+
+        Na mesma leitura guarda, já convertidas, as colunas usadas nos agregados.
+        """
+        self.fields = fields
+        self.count = 0
+        errors = []
+        frames = []
+        for chunk in self.raw_chunks():
+            rows, chunk_errors = coerce_rows(chunk, fields, table_name, first_line=self.count + 1)
+            errors.extend(chunk_errors)
+            self.count += len(chunk)
+            if columns:
+                frame = pd.DataFrame.from_records([row for row in rows if isinstance(row, dict)], columns=columns)
+                # Um bloco sem nenhuma data não pode mudar o tipo da coluna ao juntar os blocos
+                for field in columns:
+                    if fields.get(field) == 'date':
+                        frame[field] = pd.to_datetime(frame[field])
+                frames.append(frame)
+        self.frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=list(columns))
+        return errors
+
+    def columns_frame(self, columns):
+        """DataFrame com as colunas pedidas, da validação ou, se faltar alguma, relendo o arquivo"""
+        if self.frame is not None and set(columns) <= set(self.frame.columns):
+            return self.frame[columns]
+        frames = [pd.DataFrame.from_records(chunk, columns=columns) for chunk in self.chunks()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+    def chunks(self):
+        """Blocos de linhas já convertidas"""
+        for chunk in self.raw_chunks():
+            yield coerce_rows(chunk, self.fields, '')[0]
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+def read_payload(stream_paths):
+    """Lê o payload da geração: um objeto JSON ou uma requisição multipart.
+
+    No multipart, a parte 'data' traz as variáveis (e tabelas pequenas) em JSON, e cada
+    tabela grande vem em uma parte de arquivo com o nome da tabela, em NDJSON ou CSV.
+    As partes são copiadas para a pasta temporária em blocos, sem passar pela memória,
+    e seus caminhos são acrescentados a stream_paths para remoção ao fim da requisição.
+    """
+    if request.mimetype != 'multipart/form-data':
+        # JSON malformado é um erro do payload (400), não uma falha da geração
+        data = request.get_json(silent=True)
+        if data is None:
+            raise PayloadError('O corpo da requisição deve conter um objeto JSON válido')
+        return data
+    
+    if 'data' in request.files:
+        data = request.files['data'].read()
+    else:
+        data = request.form.get('data', '{}')
+    try:
+        data = json.loads(data)
+    except ValueError:
+        raise PayloadError('A parte "data" deve conter um objeto JSON')
+    if not isinstance(data, dict):
+        raise PayloadError('A parte "data" deve conter um objeto JSON')
+    
+    os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
+    for table_name, storage in request.files.items():
+        if table_name == 'data':
+            continue
+        extension = os.path.splitext(storage.filename or '')[1].lower()
+        file_format = STREAM_FORMATS.get(storage.mimetype) or STREAM_EXTENSIONS.get(extension)
+        if not file_format:
+            raise PayloadError(f'Formato da tabela {table_name} não reconhecido. Envie NDJSON ou CSV')
+        
+        path = os.path.join(app.config['TEMP_FOLDER'], f'stream_{uuid.uuid4().hex}.{file_format}')
+        stream_paths.append(path)
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for block in iter(lambda: storage.stream.read(1024 * 1024), b''):
+                digest.update(block)
+                f.write(block)
+        data[table_name] = TableStream(path, file_format, digest.hexdigest())
+    return data
+
+def fill_workbook(wb, plan, data, calculation_results=None):
+    """Preenche as abas do modelo com os dados da requisição, uma de cada vez.
+
+    O payload já deve ter passado por validate_payload, com os valores nos tipos dos
+    marcadores. As abas são independentes: o payload é o mesmo e as referências @célula
+    valem dentro da própria aba. O preenchimento é Python puro e segura o GIL, e as
+    abas compartilham as tabelas de estilos do workbook, por isso não usa threads.
+
+    calculation_results são os resultados de evaluate_calculations, calculados antes de
+    carregar o modelo e sempre sobre o payload inteiro (data pode trazer só uma fatia da
+    tabela). Retorna, por aba, as linhas ocupadas por cada tabela, como devolvido por
+    fill_sheet.
+    """
+    if calculation_results is None:
+        calculation_results = evaluate_calculations(plan, data)
+    return {title: fill_sheet(wb[title], sheet_plan, data, calculation_results[title])
+            for title, sheet_plan in plan['sheets'].items()}
+
+def fill_sheet(sheet, plan, data, calculation_results):
+    """Preenche uma aba do modelo seguindo o plano de renderização da aba.
+
+    calculation_results traz o resultado de cada célula de cálculo, por coordenada. Retorna {tabela: (primeira linha, última linha)} com as linhas ocupadas por cada tabela
+    depois do preenchimento.
+    """
+    # Substitui variáveis simples; os valores já foram convertidos na validação
+    for var in plan['variables']:
+        if var['name'] in data:
+            sheet.cell(row=var['row'], column=var['column']).value = data[var['name']]
+    
+    # Cópia das células de cálculo do plano, pois elas mudam de posição ao inserir linhas;
+    # as chaves continuam sendo as coordenadas do modelo, usadas nas referências @célula
+    calculation_cells = {coord: dict(calc_info) for coord, calc_info in plan['calculations'].items()}
+    
+    # Processa cada tabela
+    expansions = []  # (linha do modelo, linhas inseridas) de cada tabela já expandida
+    table_rows = {}
+    
+    for table_name, table in plan['tables'].items():
+        start_row = table['start_row'] + sum(count for row, count in expansions if table['start_row'] > row)
+        table_rows[table_name] = (start_row, start_row)
+        
+        if table_name in data:
+            table_data = data[table_name]
+            rows_to_insert = len(table_data)
+            table_rows[table_name] = (start_row, start_row + max(rows_to_insert, 1) - 1)
+            
+            if rows_to_insert > 0:
+                # Abre todas as linhas necessárias de uma só vez
+                if rows_to_insert > 1:  # Só insere se precisar de mais de uma linha
+                    expand_rows(sheet, start_row, rows_to_insert - 1)
+                    expansions.append((table['start_row'], rows_to_insert - 1))
+                
+                # Estilos compartilhados da linha modelo: sem formato e com o formato do tipo do campo
+                row_styles = table['template_styles']
+                typed_styles = {}
+                for field in table['fields']:
+                    style = StyleArray(row_styles.get(field['column'], StyleArray()))
+                    if field['type'] in TYPE_NUMBER_FORMATS:
+                        style.numFmtId = number_format_id(sheet.parent, TYPE_NUMBER_FORMATS[field['type']])
+                    typed_styles[field['column']] = style
+                
+                cells = sheet._cells
+                for idx, item in enumerate(table_data):
+                    current_row = start_row + idx
+                    
+                    # Para cada campo da tabela
+                    values = {}
+                    for field in table['fields']:
+                        # Obtém e formata o valor
+                        value = item.get(field['field'])
+                        if value is not None:
+                            if field['type'] == 'double':
+                                value = '{:.2f}'.format(value).replace('.', ',')
+                            values[field['column']] = value
+                    
+                    if idx == 0:
+                        # A primeira linha é a própria linha modelo, que já está formatada
+                        for col, value in values.items():
+                            cell = sheet.cell(row=current_row, column=col)
+                            cell.value = value
+                            cell._style = StyleArray(typed_styles[col])
+                        continue
+                    
+                    # Demais linhas: cria as células já com o estilo compartilhado, por índice numérico
+                    for col, style in row_styles.items():
+                        if col in values:
+                            cells[(current_row, col)] = Cell(sheet, row=current_row, column=col,
+                                                             value=values[col], style_array=typed_styles[col])
+                        else:
+                            cells[(current_row, col)] = Cell(sheet, row=current_row, column=col, style_array=style)
+                    for col, value in values.items():
+                        if col not in row_styles:
+                            cells[(current_row, col)] = Cell(sheet, row=current_row, column=col,
+                                                             value=value, style_array=typed_styles[col])
+                
+                # Acompanha o deslocamento das células de cálculo abaixo da tabela
+                if rows_to_insert > 1:
+                    for calc_info in calculation_cells.values():
+                        if calc_info['row'] > start_row:
+                            calc_info['row'] += rows_to_insert - 1
+    
+    # Grava os resultados dos cálculos, já avaliados a partir do payload
+    for coord in plan['calculation_order']:
+        calc_info = calculation_cells[coord]
+        result_cell = sheet.cell(row=calc_info['row'], column=calc_info['column'])
+        result = calculation_results[coord]
+        if result is None:
+            # Agregado sem valores, como a média de uma tabela vazia: a célula fica vazia
+            result_cell.value = None
+            continue
+        
+        # Agregados simples seguem o tipo do campo; os demais são exibidos como decimais
+        field_type = calc_info.get('field_type') if calc_info['type'] == 'simple' else 'double'
+        if calc_info['type'] == 'simple' and (calc_info['operation'] == 'contar' or field_type == 'int'):
+            result_cell.value = int(result)
+        elif isinstance(result, datetime):
+            result_cell.value = result
+            result_cell.number_format = TYPE_NUMBER_FORMATS['date']
+        elif field_type == 'double':
+            result_cell.value = '{:.2f}'.format(result).replace('.', ',')
+            result_cell.number_format = '#.##0,00'
+        else:
+            result_cell.value = result
+    
+    return table_rows
+
+def wait_for_conversion(job, mimetype):
+    """Aguarda a conversão pelo tempo pedido em ?wait= e devolve o arquivo, se pronto"""
+    wait_seconds = request.args.get('wait', type=float)
+    if not wait_seconds:
+        return None
+    wait_seconds = min(wait_seconds, app.config['MAX_WAIT_SECONDS'])
+    if job['done'].wait(wait_seconds):
+        status = app.config['CONVERSION_STATUS'].get(job['conversion_id'], {})
+        if status.get('status') == 'completed':
+            entry = app.config['ARTIFACTS'].lookup(job['conversion_id'])
+            if entry:
+                return send_artifact(entry, mimetype=mimetype, download_name=job['conversion_id'])
+    return None
+
 @app.route('/api/generate/<model_name>', methods=['POST'])
 def generate_from_model(model_name):
     filename = f'{model_name}.xlsx'
-    if filename not in app.config['MODEL_INFO']:
+    # O plano obtido aqui fixa a versão do modelo até o fim da requisição
+    plan = ensure_model(filename)
+    if not plan:
         error_pdf = generate_error_pdf("Modelo não encontrado")
         if error_pdf:
             return jsonify({
@@ -427,357 +3767,393 @@ def generate_from_model(model_name):
             }), 404
         return jsonify({'error': 'Modelo não encontrado'}), 404
     
+    stream_paths = []  # Tabelas recebidas em NDJSON/CSV, removidas ao fim da requisição
     try:
-        # Carrega o arquivo modelo
-        template_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        wb = load_workbook(template_path)
-        sheet = wb.active
-        
-        data = request.get_json()
-        model_info = app.config['MODEL_INFO'][filename]
-        
-        # Substitui variáveis simples
-        for var in model_info['variables']:
-            if var['name'] in data:
-                cell = sheet[var['cell']]
-                value = data[var['name']]
-                
-                # Converte o valor para o tipo apropriado
-                if var['type'] == 'date':
-                    try:
-                        value = datetime.strptime(value, '%d-%m-%Y')
-                    except ValueError:
-                        try:
-                            value = datetime.strptime(value, '%Y-%m-%d')
-                        except ValueError:
-                            return jsonify({'error': f'Formato de data inválido para {var["name"]}. Use DD-MM-YYYY'}), 400
-                elif var['type'] == 'int':
-                    value = int(value)
-                elif var['type'] == 'double':
-                    value = float(value)
-                
-                cell.value = value
-        
-        # Organiza os campos por tabela e encontra células de cálculo
-        tables = {}
-        table_start_rows = {}
-        table_columns = {}
-        calculation_cells = {}  # Armazena as células que contêm cálculos
-        
-        # Primeiro, vamos encontrar todas as células de cálculo e suas informações
-        for row in sheet.iter_rows():
-            for cell in row:
-                if cell.value and isinstance(cell.value, str):
-                    # Suporta operações compostas como %[somar([produtos.quantidade.somar], [produtos.valor.media])]
-                    cell_value = str(cell.value)
-                    if '%[' in cell_value and ']' in cell_value:
-                        # Extrai a expressão completa
-                        full_expr = re.search(r'%\[(.*?)\]', cell_value)
-                        if not full_expr:
-                            continue
-                        
-                        calc_expression = full_expr.group(1)
-                        
-                        # Verifica se é uma operação composta
-                        if '([' in calc_expression and '])' in calc_expression:
-                            # Extrai a operação e as expressões
-                            match = re.match(r'(\w+)\(\[(.*?)\],\s*\[(.*?)\]\)', calc_expression)
-                            if match:
-                                operation = match.group(1)
-                                expr1 = match.group(2)
-                                expr2 = match.group(3)
-                                
-                                col = ''.join(filter(str.isalpha, cell.coordinate))
-                                row_num = int(''.join(filter(str.isdigit, cell.coordinate)))
-                                calculation_cells[cell.coordinate] = {
-                                    'type': 'compound',
-                                    'operation': operation,
-                                    'expr1': expr1,
-                                    'expr2': expr2,
-                                    'column': col,
-                                    'row': row_num,
-                                    'original_text': cell.value
-                                }
-                                continue
-                        
-                        # Se não for composta, processa como expressão simples
-                        parts = calc_expression.split('.')
-                        if len(parts) >= 3:
-                            table_name = parts[0]
-                            field_name = parts[1]
-                            operation = parts[2]
-                            
-                            col = ''.join(filter(str.isalpha, cell.coordinate))
-                            row_num = int(''.join(filter(str.isdigit, cell.coordinate)))
-                            calculation_cells[cell.coordinate] = {
-                                'type': 'simple',
-                                'operation': operation,
-                                'table_name': table_name,
-                                'field_name': field_name,
-                                'column': col,
-                                'row': row_num,
-                                'original_text': cell.value
-                            }
-        
-        # Organiza as informações das tabelas
-        for table_info in model_info.get('tables', []):
-            table_name = table_info['name']
-            if table_name not in tables:
-                tables[table_name] = []
-                start_row = int(''.join(filter(str.isdigit, table_info['start_cell'])))
-                table_start_rows[table_name] = start_row
-                table_columns[table_name] = {}
-            
-            col = ''.join(filter(str.isalpha, table_info['start_cell']))
-            table_columns[table_name][table_info['field']] = col
-            
-            tables[table_name].append(table_info)
+        data = read_payload(stream_paths)
+        engine = get_model_engine(filename)
         
-        # Processa cada tabela
-        table_positions = {}  # Armazena a última linha usada para cada tabela
+        # callback_url não faz parte do documento nem da chave do cache
+        callback_url = None
+        if isinstance(data, dict) and 'callback_url' in data:
+            data = dict(data)
+            callback_url = validate_callback_url(data.pop('callback_url'))
         
-        for table_name, table_fields in tables.items():
-            if table_name in data:
-                table_data = data[table_name]
-                if not isinstance(table_data, list):
-                    return jsonify({'error': f'Dados da tabela {table_name} devem ser uma lista'}), 400
-                
-                start_row = table_start_rows[table_name]
-                rows_to_insert = len(table_data)
-                
-                if rows_to_insert > 0:
-                    # Encontra a última linha que contém cálculos para esta tabela
-                    last_calc_row = start_row
-                    for coord, calc_info in calculation_cells.items():
-                        if calc_info['table_name'] == table_name:
-                            row_num = int(''.join(filter(str.isdigit, coord)))
-                            last_calc_row = max(last_calc_row, row_num)
-                    
-                    # Primeiro, salva os cálculos se existirem
-                    calcs_to_move = {}
-                    if last_calc_row > start_row:
-                        for coord, calc_info in calculation_cells.items():
-                            if calc_info['table_name'] == table_name:
-                                row_num = int(''.join(filter(str.isdigit, coord)))
-                                col = ''.join(filter(str.isalpha, coord))
-                                if row_num == last_calc_row:
-                                    calcs_to_move[col] = sheet[coord].value
-                    
-                    # Salva a formatação da linha modelo
-                    template_row = start_row
-                    template_formats = {}
-                    max_col = 1
-                    for cell in sheet[template_row]:
-                        col_letter = cell.column_letter
-                        max_col = max(max_col, cell.column)
-                        template_formats[col_letter] = {
-                            'font': copy.copy(cell.font),
-                            'alignment': copy.copy(cell.alignment),
-                            'border': copy.copy(cell.border),
-                            'fill': copy.copy(cell.fill),
-                            'number_format': cell.number_format,
-                            'protection': copy.copy(cell.protection)
-                        }
-                    
-                    # Insere as linhas necessárias
-                    if rows_to_insert > 1:  # Só insere se precisar de mais de uma linha
-                        sheet.insert_rows(start_row + 1, rows_to_insert - 1)
-                    
-                    # Para cada item na lista de dados
-                    for idx, item in enumerate(table_data):
-                        current_row = start_row + idx
-                        
-                        # Aplica a formatação na linha atual (exceto primeira linha que já está formatada)
-                        if idx > 0:
-                            for col in range(1, max_col + 1):
-                                col_letter = get_column_letter(col)
-                                if col_letter in template_formats:
-                                    new_cell = sheet.cell(row=current_row, column=col)
-                                    format_info = template_formats[col_letter]
-                                    new_cell.font = copy.copy(format_info['font'])
-                                    new_cell.alignment = copy.copy(format_info['alignment'])
-                                    new_cell.border = copy.copy(format_info['border'])
-                                    new_cell.fill = copy.copy(format_info['fill'])
-                                    new_cell.number_format = format_info['number_format']
-                                    new_cell.protection = copy.copy(format_info['protection'])
-                        
-                        # Para cada campo da tabela
-                        for field in table_fields:
-                            col = ''.join(filter(str.isalpha, field['start_cell']))
-                            cell = f'{col}{current_row}'
-                            
-                            # Obtém e formata o valor
-                            value = item.get(field['field'])
-                            if value is not None:
-                                if field['type'] == 'date':
-                                    try:
-                                        value = datetime.strptime(value, '%d-%m-%Y')
-                                    except ValueError:
-                                        try:
-                                            value = datetime.strptime(value, '%Y-%m-%d')
-                                        except ValueError:
-                                            return jsonify({'error': f'Formato de data inválido para {field["field"]} em {table_name}'}), 400
-                                elif field['type'] == 'int':
-                                    value = int(value)
-                                elif field['type'] == 'double':
-                                    value = float(value)
-                                    value = '{:.2f}'.format(value).replace('.', ',')
-                                
-                                # Atribui o valor mantendo a formatação
-                                sheet[cell] = value
-                                if field['type'] == 'double':
-                                    sheet[cell].number_format = '#.##0,00'
-                                elif field['type'] == 'int':
-                                    sheet[cell].number_format = '#.##0'
-                                elif field['type'] == 'date':
-                                    sheet[cell].number_format = 'dd/mm/yyyy'
-                    
-                    # Move os cálculos para depois dos dados se existirem
-                    if calcs_to_move:
-                        new_calc_row = start_row + rows_to_insert
-                        for col, formula in calcs_to_move.items():
-                            new_coord = f"{col}{new_calc_row}"
-                            old_coord = f"{col}{last_calc_row}"
-                            if old_coord in calculation_cells:
-                                calc_info = calculation_cells.pop(old_coord)
-                                calc_info['row'] = new_calc_row
-                                calculation_cells[new_coord] = calc_info
-                            sheet[new_coord] = formula
-                    # Atualiza table_positions para a próxima tabela
-                    table_positions[table_name] = start_row + rows_to_insert - 1
-        
-        # Processa os cálculos após inserir todos os dados
-        calculation_results = {}  # Armazena resultados intermediários
-        
-        # Primeiro, processa todos os cálculos simples
-        for cell_coord, calc_info in calculation_cells.items():
-            if calc_info['type'] == 'simple':
-                result = None
-                target_table = calc_info['table_name']
-                target_column = None
-                field_type = None
-                
-                # Encontra a coluna correta para o campo
-                for table_info in tables[target_table]:
-                    if table_info['field'] == calc_info['field_name']:
-                        target_column = ''.join(filter(str.isalpha, table_info['start_cell']))
-                        field_type = table_info['type']
-                        break
-                
-                if target_column:
-                    values = []
-                    start_row = table_start_rows[target_table]
-                    end_row = table_positions.get(target_table, start_row)
-                    
-                    for row in range(start_row, end_row + 1):
-                        value_cell = sheet[f"{target_column}{row}"]
-                        if value_cell.value is not None:
-                            try:
-                                value_str = str(value_cell.value)
-                                if isinstance(value_cell.value, str):
-                                    value = float(value_str.replace(',', '.'))
-                                else:
-                                    value = float(value_str)
-                                values.append(value)
-                            except (ValueError, TypeError):
-                                pass
-                    
-                    if values:
-                        if calc_info['operation'] == 'somar':
-                            result = sum(values)
-                        elif calc_info['operation'] == 'media':
-                            result = sum(values) / len(values)
-                        
-                        # Armazena o resultado para uso em cálculos compostos
-                        calculation_results[cell_coord] = result
-                        
-                        # Formata e exibe o resultado
-                        if field_type == 'int':
-                            result = int(result)
-                        elif field_type == 'double':
-                            result = '{:.2f}'.format(result).replace('.', ',')
-                        
-                        sheet[cell_coord].value = result
-                        if field_type == 'double':
-                            sheet[cell_coord].number_format = '#.##0,00'
-        
-        # Agora processa os cálculos compostos
-        for cell_coord, calc_info in calculation_cells.items():
-            if calc_info['type'] == 'compound':
-                try:
-                    # Encontra os resultados das expressões
-                    def find_result(expr):
-                        # Procura a célula que contém a expressão original
-                        for coord, info in calculation_cells.items():
-                            if info['type'] == 'simple':
-                                expr_str = f"{info['table_name']}.{info['field_name']}.{info['operation']}"
-                                if expr_str == expr:
-                                    return calculation_results.get(coord)
-                        return None
-                    
-                    result1 = find_result(calc_info['expr1'])
-                    result2 = find_result(calc_info['expr2'])
-                    
-                    if result1 is not None and result2 is not None:
-                        if calc_info['operation'] == 'somar':
-                            result = result1 + result2
-                        elif calc_info['operation'] == 'subtrair':
-                            result = result1 - result2
-                        elif calc_info['operation'] == 'multiplicar':
-                            result = result1 * result2
-                        elif calc_info['operation'] == 'dividir':
-                            result = result1 / result2 if result2 != 0 else 0
-                        
-                        # Formata o resultado como número decimal
-                        result_str = '{:.2f}'.format(result).replace('.', ',')
-                        sheet[cell_coord].value = result_str
-                        sheet[cell_coord].number_format = '#.##0,00'
-                    else:
-                        print(f"Não foi possível encontrar os resultados para: {calc_info['expr1']} ou {calc_info['expr2']}")
-                except Exception as e:
-                    print(f"Erro no cálculo composto: {str(e)}")
-                    sheet[cell_coord].value = "ERRO"
+        # Valida o payload inteiro antes de carregar o modelo; a chave do cache usa os dados enviados
+        values = validate_payload(plan['validator'], data)
         
-        # Gera nomes únicos para os arquivos
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        excel_filename = f'generated_{model_name}_{timestamp}.xlsx'
-        pdf_filename = f'generated_{model_name}_{timestamp}.pdf'
+        # O XLSX só fica em temp/ quando o chamador quer o excel_url (?excel=1); senão vai
+        # para a pasta de spool e é removido ao fim da conversão
+        keep_excel = request.args.get('excel', '1' if app.config['KEEP_EXCEL'] else '0').lower() not in ('0', 'false')
         
-        # Garante que as pastas existem
-        os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
-        os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
+        # Com o cache ativo os nomes dos arquivos são endereçados pelo conteúdo
+        cache = app.config['RESULT_CACHE']
+        cache_key = None
+        if request.args.get('cache', '1').lower() not in ('0', 'false'):
+            cache_key = cache.key_for(plan['version'], engine, data, keep_excel)
+            base_name = f'generated_{model_name}_{cache_key[:32]}'
+        else:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            base_name = f'generated_{model_name}_{timestamp}_{uuid.uuid4().hex[:8]}'
+        excel_filename = f'{base_name}.xlsx'
+        pdf_filename = f'{base_name}.pdf'
+        excel_folder = app.config['TEMP_FOLDER'] if keep_excel else app.config['SPOOL_FOLDER']
+        excel_path = os.path.join(excel_folder, excel_filename)
+        pdf_path = os.path.join(app.config['DOWNLOAD_FOLDER'], pdf_filename)
+        # Modo para tabelas muito longas (?chunked=1): conversão em partes paralelas, sem excel_url.
+        # Tabelas recebidas em arquivo seguem esse modo por padrão, para que nenhuma aba
+        # carregue mais de CHUNK_ROWS linhas na memória
+        chunked = request.args.get('chunked')
+        if chunked is None:
+            chunked = any(isinstance(value, TableStream) for value in values.values())
+        else:
+            chunked = chunked.lower() not in ('0', 'false')
+        chunk_rows = app.config['CHUNK_ROWS'] if chunked else None
+        job = create_conversion_job(excel_path, pdf_path, cache_key=cache_key,
+                                    priority=get_job_priority(filename), client=get_client_id(), model=model_name,
+                                    keep_excel=keep_excel, chunk_rows=chunk_rows)
         
-        # Salva o arquivo Excel temporário e força a sincronização
-        excel_path = os.path.join(app.config['TEMP_FOLDER'], excel_filename)
-        wb.save(excel_path)
-        wb.close()
+        if cache_key:
+            # PDF idêntico já gerado: responde imediatamente
+            entry = cache.lookup(pdf_path, excel_path if keep_excel else None)
+            if entry:
+                # No modo em partes o job original não manteve o XLSX
+                job['keep_excel'] = entry[2] is not None
+                app.config['CONVERSION_STATUS'][pdf_filename] = {
+                    'status': 'completed',
+                    'message': 'Conversão concluída com sucesso',
+                    'pdf_url': f'/download/{pdf_filename}'
+                }
+                job['done'].set()
+                if callback_url:
+                    add_callback(job, callback_url)
+                return generation_response(job, cached=True)
+        
+        # Fila cheia: rejeita antes de preencher o modelo
+        scheduler = app.config['SCHEDULER']
+        if engine != 'weasyprint' and scheduler.full():
+            return queue_full_response(scheduler.eta(app.config['CONVERSION_QUEUE_MAX_DEPTH']))
+        
+        if cache_key:
+            # Requisição idêntica em andamento: acompanha o mesmo job
+            running = cache.claim(cache_key, job)
+            if running is not job:
+                if callback_url:
+                    add_callback(running, callback_url)
+                return generation_response(running)
+        
+        if callback_url:
+            job['callbacks'].append(callback_url)
+        
+        try:
+            render_document(filename, model_name, plan, values, engine, job)
+        except Exception as e:
+            # Libera quem estiver aguardando o mesmo resultado
+            if cache_key:
+                app.config['CONVERSION_STATUS'][pdf_filename] = {
+                    'status': 'error',
+                    'message': f'Erro na geração: {str(e)}'
+                }
+                job_finished(job)
+            elif isinstance(e, QueueFullError):
+                cleanup_temp_files(*job['excel_paths'])
+            raise
+        
+        return generation_response(job)
+    
+    except PayloadError as e:
+        return payload_error_response(e)
+    except QueueFullError as e:
+        return queue_full_response(e.retry_after)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cleanup_temp_files(*stream_paths)
+
+def find_chunked_table(plan, data, chunk_rows):
+    """Aba e nome da maior tabela do payload com mais de chunk_rows linhas, ou None"""
+    largest = None
+    for title, sheet_plan in plan['sheets'].items():
+        for table_name in sheet_plan['tables']:
+            rows = data.get(table_name)
+            if isinstance(rows, (list, TableStream)) and len(rows) > chunk_rows:
+                if largest is None or len(rows) > largest[2]:
+                    largest = (title, table_name, len(rows))
+    return largest[:2] if largest else None
+
+def uses_page_numbers(sheet):
+    """Indica se o cabeçalho ou o rodapé da aba exibe o número da página (&P)"""
+    header_footer = sheet.HeaderFooter
+    return any('&P' in str(getattr(header_footer, name))
+               for name in ('oddHeader', 'oddFooter', 'evenHeader', 'evenFooter', 'firstHeader', 'firstFooter'))
+
+def render_chunked(filename, plan, data, calculation_results, job, title, table_name):
+    """Divide uma tabela muito longa em partes convertidas em paralelo e depois juntadas.
+
+    Cada parte repete tudo o que está acima da tabela e recebe CHUNK_ROWS linhas; as abas
+    anteriores à da tabela ficam só na primeira parte e as posteriores, assim como o
+    rodapé da tabela, só na última. Os cálculos vêm de calculation_results, feitos uma vez
+    sobre a tabela inteira, e as partes são preenchidas uma de cada vez para limitar a
+    memória.
+    """
+    template_path = template_version_path(plan['version'])
+    chunk_rows = job['chunk_rows']
+    count = math.ceil(len(data[table_name]) / chunk_rows)
+    base_name = os.path.splitext(job['conversion_id'])[0]
+    os.makedirs(app.config['SPOOL_FOLDER'], exist_ok=True)
+    
+    # As partes ficam no spool e são removidas ao fim do job; não há excel_url
+    job['keep_excel'] = False
+    job['excel_paths'] = []
+    rows = iter(data[table_name])
+    chunk_jobs = []
+    numbered = False
+    for index in range(count):
+        with stage(job, 'template_load'):
+            wb = app.config['TEMPLATE_CACHE'].get_workbook(filename, plan['version'], template_path)
+        position = wb.sheetnames.index(title)
+        removed = []
+        if index > 0:
+            removed += wb.sheetnames[:position]
+        if index < count - 1:
+            removed += wb.sheetnames[position + 1:]
+        for sheet_name in removed:
+            wb.remove(wb[sheet_name])
+        wb.active = wb[title]
+        
+        chunk_plan = dict(plan, sheets={sheet_title: sheet_plan for sheet_title, sheet_plan in plan['sheets'].items()
+                                        if sheet_title not in removed})
+        chunk_data = dict(data)
+        chunk_data[table_name] = list(islice(rows, chunk_rows))
+        with stage(job, 'fill'):
+            table_rows = fill_workbook(wb, chunk_plan, chunk_data, calculation_results)
+        
+        sheet = wb[title]
+        if index < count - 1:
+            # O rodapé da tabela só aparece na última parte
+            sheet.print_area = f'A1:{get_column_letter(sheet.max_column)}{table_rows[title][table_name][1]}'
+        if index > 0:
+            # A numeração é ajustada antes da conversão, quando as páginas anteriores são conhecidas
+            sheet.page_setup.useFirstPageNumber = True
+            sheet.page_setup.firstPageNumber = 1
+        numbered = numbered or uses_page_numbers(sheet)
         
-        # Força a sincronização do sistema de arquivos
-        if platform.system() == 'Linux':
+        chunk_name = f'{base_name}_parte{index + 1:04d}'
+        excel_path = os.path.join(app.config['SPOOL_FOLDER'], f'{chunk_name}.xlsx')
+        with stage(job, 'save'):
+            spool_workbook(wb, excel_path)
+        wb.close()
+        job['excel_paths'].append(excel_path)
+        chunk_jobs.append(create_conversion_job(excel_path, os.path.join(app.config['SPOOL_FOLDER'], f'{chunk_name}.pdf'),
+                                                priority=job['priority'], client=job['client'], model=job['model'],
+                                                internal=True))
+    
+    app.config['CONVERSION_STATUS'][job['conversion_id']] = {
+        'status': 'processing',
+        'message': f'Convertendo {count} partes...',
+        'timings': job['timings']
+    }
+    threading.Thread(target=convert_chunks, args=(job, chunk_jobs, numbered), daemon=True).start()
+
+def render_document(filename, model_name, plan, data, engine, job):
+    """Preenche o modelo, grava o XLSX quando necessário e gera o PDF no motor escolhido"""
+    # Cálculos impossíveis com os dados enviados são recusados antes de carregar o modelo
+    with stage(job, 'fill'):
+        calculation_results = evaluate_calculations(plan, data)
+    
+    # Tabelas muito longas podem ser convertidas em partes, em paralelo
+    target = find_chunked_table(plan, data, job['chunk_rows']) if job['chunk_rows'] else None
+    if target and engine != 'weasyprint':
+        render_chunked(filename, plan, data, calculation_results, job, *target)
+        return
+    
+    # Obtém uma cópia do modelo a partir do cache
+    template_path = template_version_path(plan['version'])
+    with stage(job, 'template_load'):
+        wb = app.config['TEMPLATE_CACHE'].get_workbook(filename, plan['version'], template_path)
+    with stage(job, 'fill'):
+        fill_workbook(wb, plan, data, calculation_results)
+    
+    # Garante que as pastas existem
+    os.makedirs(os.path.dirname(job['excel_paths'][0]), exist_ok=True)
+    os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
+    
+    # Salva o arquivo Excel de forma durável somente se ele for oferecido para download
+    if job['keep_excel']:
+        with stage(job, 'save'):
+            save_workbook(wb, job['excel_paths'][0])
+        record_output(job, job['excel_paths'][0], 'xlsx')
+    
+    rendered = False
+    if engine == 'weasyprint':
+        # Renderiza no próprio processo; o LibreOffice fica como alternativa em caso de falha
+        try:
+            with stage(job, 'render'):
+                render_pdf_weasyprint(wb, job['pdf_path'])
+            complete_rendered_job(job)
+            rendered = True
+        except Exception as e:
+            print(f"Erro na renderização com WeasyPrint, usando LibreOffice: {str(e)}")
+    
+    # O LibreOffice lê a cópia em spool, que não precisa ser durável
+    if not rendered and not job['keep_excel']:
+        with stage(job, 'save'):
+            spool_workbook(wb, job['excel_paths'][0])
+    wb.close()
+    
+    # Inicia a conversão para PDF em background
+    if not rendered:
+        app.config['SCHEDULER'].put(job)
+
+def generation_response(job, cached=False):
+    """Resposta da geração: o PDF, no modo ?wait=, ou os links de acompanhamento.
+
+    O excel_url só é incluído quando o XLSX do job foi mantido.
+    """
+    # Modo síncrono opcional: devolve o PDF na própria resposta se ficar pronto a tempo
+    response = wait_for_conversion(job, 'application/pdf')
+    if response:
+        return response
+    
+    result = {
+        'message': 'Arquivo gerado com sucesso',
+        'conversion_id': job['conversion_id'],
+        'status_url': f"/conversion-status/{job['conversion_id']}",
+        'events_url': f"/conversion-events/{job['conversion_id']}"
+    }
+    if job['keep_excel']:
+        result['excel_url'] = f"/download/{os.path.basename(job['excel_paths'][0])}"
+    if cached:
+        result['cached'] = True
+    return jsonify(result)
+
+@app.route('/api/generate/<model_name>/batch', methods=['POST'])
+def generate_batch_from_model(model_name):
+    """Gera vários documentos do mesmo modelo e os converte em uma única passagem"""
+    filename = f'{model_name}.xlsx'
+    plan = ensure_model(filename)
+    if not plan:
+        return jsonify({'error': 'Modelo não encontrado'}), 404
+    
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        data = {'items': data}
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list) or not data['items']:
+        return jsonify({'error': 'Envie uma lista de payloads em "items"'}), 400
+    
+    items = data['items']
+    if len(items) > app.config['MAX_BATCH_ITEMS']:
+        return jsonify({'error': f'O lote aceita no máximo {app.config["MAX_BATCH_ITEMS"]} documentos'}), 400
+    
+    output = data.get('output', 'zip')
+    if output not in ('zip', 'pdf'):
+        return jsonify({'error': 'Formato de saída inválido. Use "zip" ou "pdf"'}), 400
+    
+    callback_url = data.get('callback_url')
+    if callback_url is not None:
+        try:
+            validate_callback_url(callback_url)
+        except PayloadError as e:
+            return payload_error_response(e)
+    
+    # Fila cheia: rejeita antes de preencher os documentos
+    scheduler = app.config['SCHEDULER']
+    if get_model_engine(filename) != 'weasyprint' and scheduler.full():
+        return queue_full_response(scheduler.eta(app.config['CONVERSION_QUEUE_MAX_DEPTH']))
+    
+    excel_paths = []
+    try:
+        # Valida todos os itens, inclusive os cálculos, antes de preencher o primeiro documento
+        payloads = []
+        errors = []
+        for index, item in enumerate(items, start=1):
             try:
-                subprocess.run(['sync'], check=True)
-            except:
-                pass
+                values = validate_payload(plan['validator'], item)
+                payloads.append((values, evaluate_calculations(plan, values)))
+            except PayloadError as e:
+                errors.extend(f'Item {index}: {error}' for error in e.errors)
+        if errors:
+            raise payload_error(errors)
+        
+        template_path = template_version_path(plan['version'])
         
-        # Garante que o arquivo existe e está completo
-        if not os.path.exists(excel_path) or os.path.getsize(excel_path) == 0:
-            raise Exception("Erro ao salvar arquivo Excel")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        batch_name = f'batch_{model_name}_{timestamp}_{uuid.uuid4().hex[:8]}'
+        os.makedirs(app.config['SPOOL_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
         
-        # Espera um momento para garantir que o arquivo foi salvo completamente
-        time.sleep(1)
+        # Com o WeasyPrint os PDFs são renderizados durante o preenchimento
+        use_weasyprint = get_model_engine(filename) == 'weasyprint'
+        work_dir = os.path.join(app.config['SPOOL_FOLDER'], batch_name)
+        rendered_paths = []
         
-        # Inicia a conversão para PDF em background
-        pdf_path = os.path.join(app.config['DOWNLOAD_FOLDER'], pdf_filename)
-        app.config['CONVERSION_QUEUE'].put((excel_path, pdf_path))
+        # O job acompanha a lista de arquivos e mede as etapas de todos os documentos
+        result_filename = f'{batch_name}.{output}'
+        result_path = os.path.join(app.config['DOWNLOAD_FOLDER'], result_filename)
+        job = create_conversion_job(excel_paths, result_path, batch=output,
+                                    priority=get_job_priority(filename, default='low'), client=get_client_id(),
+                                    model=model_name)
+        
+        # Preenche todos os documentos a partir do mesmo modelo em cache
+        for index, (item, calculation_results) in enumerate(payloads, start=1):
+            with stage(job, 'template_load'):
+                wb = app.config['TEMPLATE_CACHE'].get_workbook(filename, plan['version'], template_path)
+            with stage(job, 'fill'):
+                fill_workbook(wb, plan, item, calculation_results)
+            # Os XLSX do lote não são oferecidos para download: vão direto para o spool
+            excel_path = os.path.join(app.config['SPOOL_FOLDER'], f'{batch_name}_{index:05d}.xlsx')
+            with stage(job, 'save'):
+                spool_workbook(wb, excel_path)
+            excel_paths.append(excel_path)
+            record_output(job, excel_path, 'xlsx')
+            if use_weasyprint:
+                try:
+                    os.makedirs(work_dir, exist_ok=True)
+                    rendered_path = os.path.join(work_dir, f'{batch_name}_{index:05d}.pdf')
+                    with stage(job, 'render'):
+                        render_pdf_weasyprint(wb, rendered_path)
+                    rendered_paths.append(rendered_path)
+                except Exception as e:
+                    print(f"Erro na renderização com WeasyPrint, usando LibreOffice: {str(e)}")
+                    use_weasyprint = False
+            wb.close()
+        
+        if callback_url:
+            job['callbacks'].append(callback_url)
+        
+        rendered = False
+        if use_weasyprint:
+            try:
+                with stage(job, 'package'):
+                    package_batch(rendered_paths, output, result_path)
+                complete_rendered_job(job)
+                rendered = True
+            except Exception as e:
+                print(f"Erro ao empacotar o lote, usando LibreOffice: {str(e)}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        
+        # Envia o lote inteiro como um único item da fila
+        if not rendered:
+            scheduler.put(job)
+        
+        response = wait_for_conversion(job, 'application/pdf' if output == 'pdf' else 'application/zip')
+        if response:
+            return response
         
         return jsonify({
-            'message': 'Arquivo gerado com sucesso',
-            'excel_url': f'/download/{excel_filename}',
-            'conversion_id': pdf_filename,
-            'status_url': f'/conversion-status/{pdf_filename}'
+            'message': f'{len(excel_paths)} documentos gerados com sucesso',
+            'conversion_id': result_filename,
+            'status_url': f'/conversion-status/{result_filename}',
+            'events_url': f'/conversion-events/{result_filename}'
         })
     
+    except PayloadError as e:
+        cleanup_temp_files(*excel_paths)
+        return payload_error_response(e)
+    except QueueFullError as e:
+        cleanup_temp_files(*excel_paths)
+        return queue_full_response(e.retry_after)
     except Exception as e:
+        cleanup_temp_files(*excel_paths)
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
@@ -0,0 +1,327 @@
+"""Benchmark da geração de documentos com modelos sintéticos.
+
+Gera modelos XLSX sintéticos (só variáveis, tabela larga, tabela longa, muitas células
+de cálculo e várias tabelas), envia-os pela rota de upload e dispara a geração pelo
+cliente de testes do Flask em diferentes tamanhos de payload e níveis de concorrência.
+
+Por padrão o LibreOffice é substituído por um conversor falso, de modo que o tempo
+medido seja o do preenchimento e da gravação; use --real-soffice para converter de fato.
+O resultado é emitido em JSON, para comparar versões do motor de preenchimento.
+
+Exemplo:
+    python benchmark.py --scenarios long,calcs --rows 100,10000 --concurrency 1,4 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from openpyxl import Workbook
+
+SCENARIOS = ('variables', 'wide', 'long', 'calcs', 'multi')
+FIELD_TYPES = ('text', 'int', 'double', 'date')
+
+def build_template(scenario):
+    """Monta o modelo sintético do cenário e retorna o arquivo XLSX em memória"""
+    wb = Workbook()
+    sheet = wb.active
+    sheet.title = 'Relatorio'
+
+    if scenario == 'variables':
+        # 200 variáveis de todos os tipos, sem tabela
+        for index in range(200):
+            field_type = FIELD_TYPES[index % len(FIELD_TYPES)]
+            sheet.cell(row=index // 4 + 1, column=index % 4 + 1, value=f'${{var{index}:{field_type}}}')
+    elif scenario == 'wide':
+        # Uma tabela com 40 campos
+        for column in range(1, 41):
+            field_type = FIELD_TYPES[column % len(FIELD_TYPES)]
+            sheet.cell(row=2, column=column, value=f'#{{itens.campo{column}:{field_type}}}')
+        sheet['A4'] = '%[itens.campo2.somar]'
+    elif scenario == 'long':
+        # Uma tabela estreita com totais e rodapé mesclado abaixo dela
+        sheet['A1'] = 'Cliente: ${cliente:text}'
+        sheet['A3'] = '#{itens.nome:text}'
+        sheet['B3'] = '#{itens.quantidade:int}'
+        sheet['C3'] = '#{itens.valor:double}'
+        sheet['D3'] = '#{itens.data:date}'
+        sheet['B4'] = '%[itens.quantidade.somar]'
+        sheet['C4'] = '%[itens.valor.media]'
+        sheet['A6'] = 'Rodapé'
+        sheet.merge_cells('A6:D6')
+    elif scenario == 'calcs':
+        # Tabela com 300 células de cálculo encadeadas por referências
+        sheet['A1'] = '${taxa:double}'
+        sheet['A3'] = '#{itens.grupo:text}'
+        sheet['B3'] = '#{itens.quantidade:int}'
+        sheet['C3'] = '#{itens.valor:double}'
+        operations = ('somar', 'media', 'min', 'max', 'mediana', 'contar')
+        for index in range(300):
+            row, column = 5 + index // 10, index % 10 + 1
+            if index < 60:
+                operation = operations[index % len(operations)]
+                value = f'%[itens.valor.{operation}.grupo=g{index % 5}]'
+            else:
+                previous = sheet.cell(row=5 + (index - 60) // 10, column=(index - 60) % 10 + 1).coordinate
+                value = f'%[somar(multiplicar([@{previous}], [$taxa]), [itens.quantidade.somar])]'
+            sheet.cell(row=row, column=column, value=value)
+    elif scenario == 'multi':
+        # Três tabelas empilhadas e uma segunda aba com resumo
+        for index, row in enumerate((2, 6, 10)):
+            sheet.cell(row=row, column=1, value=f'#{{tabela{index}.nome:text}}')
+            sheet.cell(row=row, column=2, value=f'#{{tabela{index}.valor:double}}')
+            sheet.cell(row=row + 1, column=2, value=f'%[tabela{index}.valor.somar]')
+        resumo = wb.create_sheet('Resumo')
+        resumo['A1'] = 'Cliente: ${cliente:text}'
+        resumo['A2'] = '%[somar([tabela0.valor.somar], [tabela1.valor.somar], [tabela2.valor.somar])]'
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def field_value(field_type, index):
+    if field_type == 'text':
+        return f'Item {index}'
+    if field_type == 'int':
+        return index
+    if field_type == 'double':
+        return index * 1.25
+    return f'{index % 28 + 1:02d}-{index % 12 + 1:02d}-2024'
+
+def build_payload(scenario, rows):
+    """Payload do cenário com `rows` linhas em cada tabela"""
+    if scenario == 'variables':
+        return {f'var{index}': field_value(FIELD_TYPES[index % len(FIELD_TYPES)], index) for index in range(200)}
+    if scenario == 'wide':
+        return {'itens': [{f'campo{column}': field_value(FIELD_TYPES[column % len(FIELD_TYPES)], index)
+                           for column in range(1, 41)} for index in range(rows)]}
+    if scenario == 'long':
+        return {'cliente': 'ACME', 'itens': [{'nome': f'Produto {index}', 'quantidade': index,
+                                              'valor': index * 1.5, 'data': field_value('date', index)}
+                                             for index in range(rows)]}
+    if scenario == 'calcs':
+        return {'taxa': 1.01, 'itens': [{'grupo': f'g{index % 5}', 'quantidade': index, 'valor': index * 0.75}
+                                        for index in range(rows)]}
+    return dict({'cliente': 'ACME'}, **{f'tabela{table}': [{'nome': f'Item {index}', 'valor': index * 2.5}
+                                                          for index in range(rows)] for table in range(3)})
+
+def current_rss():
+    """Memória residente atual do processo, em bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Sem /proc, usa o pico do processo (KB no Linux, bytes no macOS)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+    return {
+        'p50': rank(0.50),
+        'p90': rank(0.90),
+        'p99': rank(0.99),
+        'max': round(ordered[-1], 4),
+        'mean': round(sum(ordered) / len(ordered), 4)
+    }
+
+def install_stub_converter(app_module):
+    """Substitui o LibreOffice por um conversor que grava um PDF mínimo válido"""
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    writer.add_blank_page(width=595, height=842)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    blank_pdf = buffer.getvalue()
+
+    def convert(self, excel_path, pdf_path):
+        with open(pdf_path, 'wb') as f:
+            f.write(blank_pdf)
+
+    def convert_many(self, excel_paths, outdir):
+        os.makedirs(outdir, exist_ok=True)
+        pdf_paths = []
+        for excel_path in excel_paths:
+            pdf_path = os.path.join(outdir, os.path.splitext(os.path.basename(excel_path))[0] + '.pdf')
+            convert(self, excel_path, pdf_path)
+            pdf_paths.append(pdf_path)
+        return pdf_paths
+
+    app_module.OfficeInstance.convert = convert
+    app_module.OfficeInstance.convert_many = convert_many
+    app_module.OfficeInstance.is_healthy = lambda self: True
+
+def install_rss_probe(app_module, peaks):
+    """Registra a maior memória residente observada ao fim de cada etapa"""
+    original_stage = app_module.stage
+    lock = threading.Lock()
+
+    class Probe:
+        def __init__(self, job, name):
+            self.context = original_stage(job, name)
+            self.name = name
+
+        def __enter__(self):
+            return self.context.__enter__()
+
+        def __exit__(self, *exc_info):
+            result = self.context.__exit__(*exc_info)
+            rss = current_rss()
+            with lock:
+                peaks[self.name] = max(peaks.get(self.name, 0), rss)
+            return result
+
+    app_module.stage = Probe
+
+def generate_once(client, model_name, payload):
+    """Dispara uma geração e aguarda o status final pelo fluxo de eventos"""
+    started = time.perf_counter()
+    response = client.post(f'/api/generate/{model_name}?cache=0', json=payload)
+    if response.status_code != 200:
+        return time.perf_counter() - started, {'status': 'error', 'message': response.get_data(as_text=True)}
+
+    events = client.get(response.get_json()['events_url']).get_data(as_text=True)
+    final = {}
+    for line in events.splitlines():
+        if line.startswith('data: '):
+            final = json.loads(line[len('data: '):])
+    return time.perf_counter() - started, final
+
+def run_level(app_module, peaks, model_name, payload, concurrency, requests):
+    """Executa `requests` gerações com `concurrency` clientes simultâneos"""
+    peaks.clear()
+    clients = [app_module.app.test_client() for _ in range(concurrency)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda index: generate_once(clients[index % concurrency], model_name, payload),
+                                    range(requests)))
+    elapsed = time.perf_counter() - started
+
+    stage_timings = {}
+    errors = []
+    for _, status in results:
+        if status.get('status') != 'completed':
+            errors.append(status.get('message', 'status desconhecido'))
+        for name, seconds in status.get('timings', {}).items():
+            stage_timings.setdefault(name, []).append(seconds)
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'throughput_rps': round(requests / elapsed, 3),
+        'latency_seconds': percentiles([latency for latency, _ in results]),
+        'stages': {name: dict(percentiles(values),
+                              peak_rss_mb=round(peaks[name] / 1048576, 1) if name in peaks else None)
+                   for name, values in sorted(stage_timings.items())},
+        'peak_rss_mb': round(max([current_rss()] + list(peaks.values())) / 1048576, 1),
+        'errors': len(errors),
+        'error_samples': errors[:3]
+    }
+
+def run_scenarios(args, scenarios, rows_levels, concurrency_levels):
+    """Envia cada modelo sintético e mede a geração em todas as combinações pedidas"""
+    import app as app_module
+
+    if not args.real_soffice:
+        install_stub_converter(app_module)
+    peaks = {}
+    install_rss_probe(app_module, peaks)
+    client = app_module.app.test_client()
+
+    results = []
+    for scenario in scenarios:
+        model_name = f'bench_{scenario}'
+        started = time.perf_counter()
+        response = client.post('/upload', data={'file': (build_template(scenario), f'{model_name}.xlsx')})
+        analyze_seconds = time.perf_counter() - started
+        if response.status_code != 200:
+            print(f"Erro ao enviar o modelo {scenario}: {response.get_data(as_text=True)}", file=sys.stderr)
+            continue
+
+        for rows in ([0] if scenario == 'variables' else rows_levels):
+            payload = build_payload(scenario, rows)
+            for concurrency in concurrency_levels:
+                print(f"{scenario}: {rows} linhas, {concurrency} clientes", file=sys.stderr)
+                result = run_level(app_module, peaks, model_name, payload, concurrency, args.requests)
+                results.append(dict({'scenario': scenario, 'rows': rows,
+                                     'analyze_seconds': round(analyze_seconds, 4)}, **result))
+
+    return results
+
+def git_revision(path):
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark da geração de documentos com modelos sintéticos')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'Cenários: {", ".join(SCENARIOS)}')
+    parser.add_argument('--rows', default='10,1000', help='Linhas por tabela no payload, separadas por vírgula')
+    parser.add_argument('--concurrency', default='1,4', help='Clientes simultâneos, separados por vírgula')
+    parser.add_argument('--requests', type=int, default=20, help='Gerações por combinação')
+    parser.add_argument('--real-soffice', action='store_true', help='Converte com o LibreOffice instalado')
+    parser.add_argument('--output', help='Arquivo JSON de saída (padrão: saída padrão)')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Cenários desconhecidos: {", ".join(sorted(unknown))}')
+    rows_levels = [int(value) for value in args.rows.split(',') if value]
+    concurrency_levels = [int(value) for value in args.concurrency.split(',') if value]
+
+    # A aplicação usa pastas relativas: roda em um diretório temporário isolado
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    output_path = os.path.abspath(args.output) if args.output else None
+    work_dir = tempfile.mkdtemp(prefix='apipdf_bench_')
+    os.chdir(work_dir)
+    os.environ.setdefault('STATUS_STORE', 'memory')
+    os.environ.setdefault('CONVERSION_QUEUE_MAX_DEPTH', str(max(concurrency_levels) * args.requests + 100))
+    sys.path.insert(0, repo_dir)
+    # Os logs da aplicação vão para a saída de erro, deixando a saída padrão só com o JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_scenarios(args, scenarios, rows_levels, concurrency_levels)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(repo_dir),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'converter': 'soffice' if args.real_soffice else 'stub'
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()